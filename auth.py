@@ -0,0 +1,75 @@
+'''auth.py'''
+
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from fastapi import Depends, HTTPException
+from fastapi.security import OAuth2PasswordBearer
+import jwt
+from cache import LRUCache, revoked_tokens
+from models import Employees
+from repository import Repository
+from settings import Settings, settings
+
+SECRET_KEY = settings.jwt_secret_key
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 600
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/employee/token")
+
+# Проверенные claims по токену, живут до exp токена
+verified_tokens = LRUCache(maxsize=settings.jwt_cache_size)
+
+def configure_auth(config: Settings = settings) -> None:
+    '''Функция для настройки секрета JWT и кеша проверенных токенов из конфигурации приложения'''
+    global SECRET_KEY
+    SECRET_KEY = config.jwt_secret_key
+    verified_tokens.maxsize = config.jwt_cache_size
+    verified_tokens.clear()
+
+def create_access_token(data: dict, expires_delta: timedelta | None = None):
+    '''Функция для создания доступа токена'''
+    to_encode = data.copy()
+    if expires_delta:
+        expire = datetime.now(timezone.utc) + expires_delta
+    else:
+        expire = datetime.now(timezone.utc) + timedelta(minutes=15)
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+def decode_access_token(token: str) -> dict:
+    '''Функция для проверки подписи токена с кешированием claims'''
+    claims = verified_tokens.get(token)
+    if claims is None:
+        try:
+            claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM],
+                                options={"require": ["exp", "jti"]})
+        except jwt.PyJWTError:
+            raise HTTPException(status_code=401, detail="Invalid token",
+                                headers={"WWW-Authenticate": "Bearer"})
+        verified_tokens.set(token, claims, ttl=claims["exp"] - time.time())
+    elif claims["exp"] <= time.time():
+        verified_tokens.pop(token)
+        raise HTTPException(status_code=401, detail="Token expired",
+                            headers={"WWW-Authenticate": "Bearer"})
+    if claims["jti"] in revoked_tokens:
+        raise HTTPException(status_code=401, detail="Token revoked",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return claims
+
+async def revoke_token(claims: dict) -> None:
+    '''Функция для отзыва токена до истечения его срока во всех воркерах'''
+    await Repository.revoke_token(claims["jti"], claims["exp"])
+
+async def get_token_claims(token: str = Depends(oauth2_scheme)) -> dict:
+    '''Зависимость для получения проверенных claims bearer-токена'''
+    return decode_access_token(token)
+
+async def get_current_employee(claims: dict = Depends(get_token_claims)) -> Employees:
+    '''Зависимость для получения текущего работника по токену'''
+    employee = await Repository.get_employee_by_login(claims.get("sub") or "")
+    if employee is None:
+        raise HTTPException(status_code=401, detail="User not found",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return employee
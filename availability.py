@@ -0,0 +1,41 @@
+'''availability.py'''
+
+from datetime import date
+from typing import Dict, List, Sequence
+import numpy as np
+
+def daily_counts_from_offsets(days: int, starts: Sequence[int], ends: Sequence[int],
+                              is_business: Sequence[bool]) -> Dict[str, List[int]]:
+    '''Функция для подсчета отсутствующих по дням разностным массивом
+
+    starts/ends - номера первого и последнего дня отсутствия от начала периода (включительно).
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64) + 1
+    business_mask = np.asarray(is_business, dtype=bool)
+
+    def occupancy(mask: np.ndarray) -> List[int]:
+        diff = (np.bincount(starts[mask], minlength=days + 1)
+                - np.bincount(ends[mask], minlength=days + 1))
+        return np.cumsum(diff[:days]).tolist()
+
+    business = occupancy(business_mask)
+    vacation = occupancy(~business_mask)
+    return {
+        'vacation': vacation,
+        'business': business,
+        'total': [a + b for a, b in zip(vacation, business)],
+    }
+
+def daily_absence_counts(date_from: date, date_to: date, absences: Sequence[dict]) -> Dict[str, List[int]]:
+    '''Функция для подсчета отсутствующих по дням
+
+    absences - строки с type, start_date, end_date, уже обрезанные по [date_from, date_to].
+    '''
+    origin = date_from.toordinal()
+    return daily_counts_from_offsets(
+        (date_to - date_from).days + 1,
+        [row['start_date'].toordinal() - origin for row in absences],
+        [row['end_date'].toordinal() - origin for row in absences],
+        [row['type'] == 'business' for row in absences],
+    )
@@ -0,0 +1,75 @@
+'''bench_list_serialization.py
+
+Сравнение сериализации списка работников: путь по умолчанию (валидация через схему
+EmployeeListItem и jsonable_encoder + json) против orjson_list_response (строки из .values()
+как есть), который включается настройкой list_response_fast_path.
+
+Запуск: python -m benchmarks.bench_list_serialization --rows 50000
+'''
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from fastapi.encoders import jsonable_encoder
+from schemas import EmployeeListItem, EMPLOYEE_LIST_FIELDS
+from responses import orjson_list_response
+
+def generate(rows: int) -> list:
+    '''Функция для генерации строк работников в виде результата .values()'''
+    return [
+        {
+            "id": index,
+            "last_name": f"ivanov{index}",
+            "first_name": "ivan",
+            "patronymic": "ivanovich",
+            "email": f"ivanov{index}@example.com",
+            "login": f"ivanov{index}",
+            "is_supervisor": "no",
+            "is_vacation": "yes" if index % 10 == 0 else "no",
+        }
+        for index in range(rows)
+    ]
+
+def pydantic_path(rows: list) -> bytes:
+    '''Функция для сериализации через схему и стандартный json'''
+    validated = [EmployeeListItem.model_validate(row) for row in rows]
+    return json.dumps(jsonable_encoder(validated, exclude_unset=True), ensure_ascii=False,
+                      separators=(",", ":")).encode("utf-8")
+
+async def orjson_path(rows: list) -> bytes:
+    '''Функция для сериализации через orjson_list_response с чтением всего потока'''
+    response = orjson_list_response(rows)
+    if hasattr(response, "body_iterator"):
+        return b"".join([chunk async for chunk in response.body_iterator])
+    return response.body
+
+def measure(name: str, run, runs: int) -> float:
+    '''Функция для замера медианы времени run()'''
+    latencies = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        run()
+        latencies.append((time.perf_counter() - started) * 1000)
+    median = statistics.median(latencies)
+    print(f"{name}: median={median:.1f} ms min={min(latencies):.1f} ms")
+    return median
+
+def main() -> None:
+    '''Функция запуска бенчмарка'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = generate(args.rows)
+    assert set(rows[0]) == set(EMPLOYEE_LIST_FIELDS)
+    assert json.loads(pydantic_path(rows[:100])) == json.loads(asyncio.run(orjson_path(rows[:100])))
+    print(f"rows={args.rows}")
+    slow = measure("pydantic+json", lambda: pydantic_path(rows), args.runs)
+    fast = measure("orjson", lambda: asyncio.run(orjson_path(rows)), args.runs)
+    print(f"speedup={slow / fast:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+'''bench_metrics_overhead.py
+
+Накладные расходы сбора метрик на запрос: MetricsMiddleware вокруг пустого ASGI-приложения
+против голого приложения, стоимость record_query на один SQL-запрос и время render /metrics.
+При --db-url дополнительно сравнивается GET /employee/get_all?limit=1 через create_app
+с MetricsMiddleware и без нее.
+
+Запуск: python -m benchmarks.bench_metrics_overhead --requests 200000
+'''
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from metrics import MetricsMiddleware, MetricsRegistry, RequestStats, current_request
+from metrics import record_query, render
+
+class Route:
+    '''Класс маршрута-заглушки с шаблоном пути, как у APIRoute'''
+    path_format = "/employee/{user_id}"
+
+ROUTE = Route()
+START = {"type": "http.response.start", "status": 200, "headers": []}
+BODY = {"type": "http.response.body", "body": b"{}"}
+
+async def bare_app(scope, receive, send) -> None:
+    '''Функция ASGI-приложения, отвечающего сразу без работы'''
+    scope["route"] = ROUTE
+    await send(START)
+    await send(BODY)
+
+async def receive() -> dict:
+    '''Функция получения тела запроса (пустого)'''
+    return {"type": "http.request", "body": b""}
+
+async def send(message) -> None:
+    '''Функция отправки ответа в никуда'''
+
+async def per_request_ns(app, requests: int) -> float:
+    '''Функция для замера среднего времени одного вызова app в наносекундах'''
+    scope = {"type": "http", "method": "GET", "path": "/employee/1"}
+    started = time.perf_counter_ns()
+    for _ in range(requests):
+        await app(scope, receive, send)
+    return (time.perf_counter_ns() - started) / requests
+
+def record_query_ns(calls: int) -> float:
+    '''Функция для замера record_query внутри запроса в наносекундах'''
+    token = current_request.set(RequestStats(send))
+    try:
+        started = time.perf_counter_ns()
+        for _ in range(calls):
+            record_query("SELECT 1", 0.001)
+        return (time.perf_counter_ns() - started) / calls
+    finally:
+        current_request.reset(token)
+
+async def end_to_end(db_url: str, requests: int) -> dict:
+    '''Функция для сравнения медианы запроса к БД через приложение с метриками и без'''
+    from httpx import ASGITransport, AsyncClient
+    from main import create_app
+    from settings import Settings
+
+    config = Settings(database_url=db_url)
+    metered = create_app(config)
+    bare = create_app(config)
+    bare.user_middleware = [item for item in bare.user_middleware if item.cls is not MetricsMiddleware]
+    latencies = {"without_metrics": [], "with_metrics": []}
+    # Соединения с БД общие (Tortoise глобален), поэтому lifespan нужен только одному приложению;
+    # запросы чередуются, чтобы дрейф БД и кешей одинаково влиял на оба варианта
+    async with metered.router.lifespan_context(metered):
+        clients = {
+            name: AsyncClient(transport=ASGITransport(app=app), base_url="http://bench")
+            for name, app in (("without_metrics", bare), ("with_metrics", metered))
+        }
+        for _ in range(requests):
+            for name, client in clients.items():
+                started = time.perf_counter_ns()
+                await client.get("/employee/get_all", params={"limit": 1})
+                latencies[name].append((time.perf_counter_ns() - started) / 1000)
+        for client in clients.values():
+            await client.aclose()
+    results = {name: statistics.median(values) for name, values in latencies.items()}
+    return results
+
+async def run(args: argparse.Namespace) -> None:
+    '''Функция прогона замеров'''
+    bare = min([await per_request_ns(bare_app, args.requests) for _ in range(args.runs)])
+    metered_app = MetricsMiddleware(bare_app, MetricsRegistry())
+    metered = min([await per_request_ns(metered_app, args.requests) for _ in range(args.runs)])
+    print(f"bare ASGI app:            {bare:8.0f} ns/request")
+    print(f"with MetricsMiddleware:   {metered:8.0f} ns/request (+{metered - bare:.0f} ns)")
+    print(f"record_query:             {record_query_ns(args.requests):8.0f} ns/query")
+
+    registry = metered_app.registry
+    for index in range(args.routes):
+        registry.route(f"/route/{index}", "GET").observe(RequestStats(send), 0.01)
+    started = time.perf_counter()
+    body = render(registry.snapshot())
+    print(f"render /metrics:          {(time.perf_counter() - started) * 1000:8.2f} ms "
+          f"for {args.routes} routes, {len(body)} bytes")
+
+    if args.db_url:
+        results = await end_to_end(args.db_url, args.db_requests)
+        for name, median in results.items():
+            print(f"GET /employee/get_all {name:<16} median={median:.0f} us")
+        print(f"overhead: {results['with_metrics'] - results['without_metrics']:+.0f} us per request")
+
+def main() -> None:
+    '''Функция запуска бенчмарка'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--routes", type=int, default=40, help="Число маршрутов для замера render")
+    parser.add_argument("--db-url", default=os.getenv("DATABASE_URL"))
+    parser.add_argument("--db-requests", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+'''bench_password_hashing.py
+
+Сравнение p99 легкого GET-эндпоинта под нагрузкой логинами:
+bcrypt прямо в event loop против bcrypt в пуле PasswordHasher.
+
+Запуск: python -m benchmarks.bench_password_hashing --logins 8 --reads 500
+'''
+
+import argparse
+import asyncio
+import statistics
+import time
+import httpx
+from fastapi import FastAPI
+from hashing import PasswordHasher, pwd_context
+
+def build_app(hasher: PasswordHasher | None, hashed_password: str) -> FastAPI:
+    '''Функция для сборки тестового приложения с логином и чтением'''
+    app = FastAPI()
+
+    @app.post("/login")
+    async def login():
+        if hasher is None:
+            return pwd_context.verify("password", hashed_password)
+        return await hasher.verify("password", hashed_password)
+
+    @app.get("/read")
+    async def read():
+        return {"ok": True}
+
+    return app
+
+async def run(app: FastAPI, logins: int, reads: int) -> list:
+    '''Функция для замера задержек чтения при постоянном потоке логинов'''
+    latencies = []
+    stop = asyncio.Event()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                 base_url="http://bench") as client:
+        async def login_loop():
+            while not stop.is_set():
+                await client.post("/login")
+
+        login_tasks = [asyncio.create_task(login_loop()) for _ in range(logins)]
+        await asyncio.sleep(0.1)
+        for _ in range(reads):
+            started = time.perf_counter()
+            await client.get("/read")
+            latencies.append(time.perf_counter() - started)
+        stop.set()
+        await asyncio.gather(*login_tasks)
+    return latencies
+
+def report(name: str, latencies: list) -> None:
+    '''Функция для вывода перцентилей'''
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{name:<10} p50={quantiles[49] * 1000:8.2f} ms  p99={quantiles[98] * 1000:8.2f} ms")
+
+def main() -> None:
+    '''Функция запуска бенчмарка'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=8, help="Параллельных потоков логина")
+    parser.add_argument("--reads", type=int, default=500, help="Число замеряемых чтений")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread")
+    args = parser.parse_args()
+
+    hashed_password = pwd_context.hash("password")
+    report("baseline", asyncio.run(run(build_app(None, hashed_password), 0, args.reads)))
+    report("inline", asyncio.run(run(build_app(None, hashed_password), args.logins, args.reads)))
+    hasher = PasswordHasher(args.executor, args.workers, queue_size=args.logins)
+    try:
+        report("executor", asyncio.run(run(build_app(hasher, hashed_password), args.logins, args.reads)))
+    finally:
+        hasher.shutdown()
+    print(hasher.metrics())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+'''cache.py'''
+
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+from settings import Settings, settings
+
+class LRUCache:
+    '''Класс ограниченного LRU-кеша с временем жизни записей'''
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        '''Функция для получения значения, просроченные записи удаляются'''
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        '''Функция для записи значения; ttl переопределяет время жизни по умолчанию'''
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        '''Функция для удаления записи'''
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        '''Функция для очистки кеша'''
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def metrics(self) -> dict:
+        '''Функция для получения счетчиков кеша'''
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+# Работники по id и по логину в нижнем регистре; сбрасываются записями в Repository и по NOTIFY
+employees_by_id = LRUCache(maxsize=settings.employee_cache_size, ttl=settings.employee_cache_ttl)
+employees_by_login = LRUCache(maxsize=settings.employee_cache_size, ttl=settings.employee_cache_ttl)
+
+def configure_employee_caches(config: Settings = settings) -> None:
+    '''Функция для настройки размеров и времени жизни кешей работников из конфигурации приложения'''
+    for cache in (employees_by_id, employees_by_login):
+        cache.maxsize = config.employee_cache_size
+        cache.ttl = config.employee_cache_ttl
+        cache.clear()
+
+# Канал NOTIFY для сброса работников в кешах остальных воркеров
+EMPLOYEE_CACHE_CHANNEL = "employee_cache"
+
+def drop_employees(message: dict) -> None:
+    '''Функция для сброса работников из кешей по сообщению {"employees": [[id, login], ...]} или {"clear": true}'''
+    if message.get("clear"):
+        employees_by_id.clear()
+        employees_by_login.clear()
+        return
+    for employee_id, login in message["employees"]:
+        employees_by_id.pop(employee_id)
+        if login:
+            employees_by_login.pop(login.lower())
+
+# Отозванные jti -> exp (unix time) всех воркеров: хранятся в БД, новые приходят по NOTIFY
+revoked_tokens: dict = {}
+REVOKED_TOKENS_CHANNEL = "revoked_tokens"
+
+def add_revoked_tokens(message: dict) -> None:
+    '''Функция для пополнения отозванных токенов по сообщению {"tokens": [[jti, exp], ...]}'''
+    now = time.time()
+    for jti in [jti for jti, exp in revoked_tokens.items() if exp <= now]:
+        del revoked_tokens[jti]
+    for jti, exp in message["tokens"]:
+        if exp > now:
+            revoked_tokens[jti] = exp
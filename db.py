@@ -0,0 +1,196 @@
+'''db.py'''
+
+import asyncio
+import math
+import time
+from contextvars import ContextVar
+from typing import Optional
+import asyncpg
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
+from tortoise import connections
+from tortoise.backends.asyncpg.client import AsyncpgDBClient, TransactionWrapper
+from tortoise.backends.base.client import BaseDBAsyncClient, BaseTransactionWrapper
+from tortoise.backends.base.client import TransactionContextPooled
+from tortoise.backends.base.config_generator import expand_db_url
+from metrics import record_query
+from settings import Settings, settings as default_settings
+
+# Модуль сам является engine для Tortoise: "engine": "db" -> client_class ниже
+ENGINE = "db"
+POOL_DEFAULTS = {
+    "max_queries": 50000,
+    "max_inactive_connection_lifetime": 300.0,
+    "setup": None,
+    "init": None,
+    "record_class": asyncpg.Record,
+}
+
+class PoolAcquireTimeout(asyncio.TimeoutError):
+    '''Исключение: свободное соединение не получено за db_acquire_timeout'''
+
+class MeteredPool(asyncpg.Pool):
+    '''Класс пула asyncpg с таймаутом захвата по умолчанию и счетчиками ожидания'''
+
+    def __init__(self, *args, acquire_timeout: Optional[float] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquire_timeout = acquire_timeout
+        self.waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.acquire_seconds = 0.0
+        self.max_acquire_seconds = 0.0
+
+    async def _acquire(self, timeout):
+        '''Функция для захвата соединения с замером ожидания'''
+        if timeout is None:
+            timeout = self.acquire_timeout
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            connection = await super()._acquire(timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise PoolAcquireTimeout(f"No database connection available within {timeout} s")
+        finally:
+            self.waiting -= 1
+        elapsed = time.perf_counter() - started
+        self.acquired += 1
+        self.acquire_seconds += elapsed
+        self.max_acquire_seconds = max(self.max_acquire_seconds, elapsed)
+        return connection
+
+    def metrics(self) -> dict:
+        '''Функция для получения состояния пула'''
+        size = self.get_size()
+        return {
+            "min_size": self.get_min_size(),
+            "max_size": self.get_max_size(),
+            "size": size,
+            "in_use": size - self.get_idle_size(),
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "acquire_ms_avg": round(self.acquire_seconds / self.acquired * 1000, 3) if self.acquired else 0.0,
+            "acquire_ms_max": round(self.max_acquire_seconds * 1000, 3),
+        }
+
+class QueryMeterMixin:
+    '''Примесь к клиентам Tortoise: учитывает каждый SQL-запрос в метриках текущего HTTP-запроса'''
+
+    async def _translate_exceptions(self, func, *args, **kwargs):
+        # Все execute_* проходят здесь с текстом запроса первым аргументом; start() транзакции - без него
+        if not args:
+            return await super()._translate_exceptions(func, *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return await super()._translate_exceptions(func, *args, **kwargs)
+        finally:
+            record_query(args[0], time.perf_counter() - started)
+
+class MeteredTransactionWrapper(QueryMeterMixin, TransactionWrapper):
+    '''Класс транзакции Tortoise с учетом запросов'''
+
+class MeteredAsyncpgDBClient(QueryMeterMixin, AsyncpgDBClient):
+    '''Клиент Tortoise, создающий MeteredPool вместо обычного пула asyncpg и учитывающий запросы'''
+
+    def _in_transaction(self) -> TransactionContextPooled:
+        return TransactionContextPooled(MeteredTransactionWrapper(self))
+
+    async def create_pool(self, **kwargs) -> asyncpg.Pool:
+        acquire_timeout = kwargs.pop("acquire_timeout", None)
+        pool = MeteredPool(None, acquire_timeout=acquire_timeout, **{**POOL_DEFAULTS, **kwargs})
+        await pool
+        return pool
+
+client_class = MeteredAsyncpgDBClient
+
+PRIMARY = "default"
+REPLICA = "replica"
+READ_PRIMARY_COOKIE = "read_primary_until"
+SAFE_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+# True -> чтения этого запроса идут в primary (запись или окно read-your-writes)
+read_primary: ContextVar[bool] = ContextVar("read_primary", default=False)
+
+def _credentials(db_url: str, config: Settings) -> dict:
+    '''Функция для сборки параметров подключения и пула для одной базы'''
+    credentials = expand_db_url(db_url)["credentials"]
+    credentials.update(
+        minsize=config.db_pool_min_size,
+        maxsize=config.db_pool_max_size,
+        max_queries=config.db_max_queries,
+        max_inactive_connection_lifetime=config.db_max_inactive_connection_lifetime,
+        statement_cache_size=config.db_statement_cache_size,
+        max_cached_statement_lifetime=config.db_max_cached_statement_lifetime,
+        acquire_timeout=config.db_acquire_timeout,
+    )
+    return credentials
+
+def tortoise_config(db_url: Optional[str] = None, config: Settings = default_settings,
+                    replica_url: Optional[str] = None) -> dict:
+    '''Функция для сборки конфигурации Tortoise с параметрами пула из настроек.
+
+    Если задан адрес реплики, добавляется соединение "replica" только для чтения.
+    '''
+    db_connections = {PRIMARY: {"engine": ENGINE, "credentials": _credentials(db_url or config.database_url, config)}}
+    replica_url = replica_url or config.database_replica_url
+    if replica_url:
+        db_connections[REPLICA] = {"engine": ENGINE, "credentials": _credentials(replica_url, config)}
+    return {
+        "connections": db_connections,
+        "apps": {"models": {"models": ["models"], "default_connection": PRIMARY}},
+    }
+
+def read_connection_name() -> str:
+    '''Функция для выбора соединения для чтения: реплика, если она есть и нет причин читать из primary'''
+    if (read_primary.get() or REPLICA not in connections.db_config
+            or isinstance(connections.get(PRIMARY), BaseTransactionWrapper)):
+        return PRIMARY
+    return REPLICA
+
+def read_connection() -> BaseDBAsyncClient:
+    '''Функция для получения соединения для чтения'''
+    return connections.get(read_connection_name())
+
+class ReadYourWritesMiddleware:
+    '''ASGI-middleware для чтения из primary после записи того же клиента.
+
+    Ответ на запрос с записью ставит cookie со временем окончания окна; пока оно не истекло,
+    чтения клиента идут в primary. Cookie хранится у клиента, поэтому работает между воркерами.
+    '''
+
+    def __init__(self, app, window: Optional[float] = None):
+        self.app = app
+        self.window = default_settings.replica_read_your_writes_seconds if window is None else window
+
+    def _in_window(self, scope) -> bool:
+        '''Функция для проверки, что клиент еще в окне read-your-writes'''
+        until = HTTPConnection(scope).cookies.get(READ_PRIMARY_COOKIE)
+        try:
+            return until is not None and float(until) > time.time()
+        except ValueError:
+            return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        write = scope["method"] not in SAFE_METHODS
+
+        async def send_with_cookie(message):
+            if write and self.window > 0 and message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append("set-cookie", f"{READ_PRIMARY_COOKIE}={time.time() + self.window:.3f}; "
+                                             f"Max-Age={math.ceil(self.window)}; Path=/; HttpOnly; SameSite=Lax")
+            await send(message)
+
+        token = read_primary.set(write or self._in_window(scope))
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            read_primary.reset(token)
+
+def pool_metrics(name: str = PRIMARY) -> dict:
+    '''Функция для получения метрик пула соединения Tortoise (пустой словарь до подключения)'''
+    pool = getattr(connections.get(name), "_pool", None)
+    return pool.metrics() if isinstance(pool, MeteredPool) else {}
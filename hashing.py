@@ -0,0 +1,109 @@
+'''hashing.py'''
+
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from passlib.context import CryptContext
+from metrics import record_hash
+from settings import settings
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+class PasswordHasherBusy(Exception):
+    '''Исключение при переполненной очереди хеширования'''
+
+def _timed_hash(password: str) -> tuple:
+    '''Функция хеширования пароля в пуле с замером времени'''
+    started = time.monotonic()
+    return pwd_context.hash(password), time.monotonic() - started
+
+def _timed_verify(plain_password: str, hashed_password: str) -> tuple:
+    '''Функция проверки пароля в пуле с замером времени'''
+    started = time.monotonic()
+    return pwd_context.verify(plain_password, hashed_password), time.monotonic() - started
+
+class PasswordHasher:
+    '''Класс для выполнения bcrypt вне event loop в ограниченном пуле'''
+    def __init__(self, executor: str = "thread", workers: int = 1, queue_size: int = 0):
+        self.executor_kind = executor
+        self.workers = workers
+        self.max_pending = workers + queue_size
+        self._executor: Executor | None = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.hash_seconds_total = 0.0
+        self.hash_seconds_max = 0.0
+        self.wait_seconds_total = 0.0
+
+    def configure(self, executor: str, workers: int, queue_size: int) -> None:
+        '''Функция для смены параметров пула; текущий пул закрывается и создается заново по требованию'''
+        self.shutdown()
+        self.executor_kind = executor
+        self.workers = workers
+        self.max_pending = workers + queue_size
+
+    def _get_executor(self) -> Executor:
+        '''Функция для ленивого создания пула'''
+        if self._executor is None:
+            if self.executor_kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _run(self, func, *args):
+        '''Функция для отправки задачи в пул с учетом очереди и задержек'''
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self.pending += 1
+        started = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            result, hash_seconds = await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        self.hash_seconds_total += hash_seconds
+        self.hash_seconds_max = max(self.hash_seconds_max, hash_seconds)
+        elapsed = time.monotonic() - started
+        self.wait_seconds_total += max(0.0, elapsed - hash_seconds)
+        record_hash(elapsed)
+        return result
+
+    async def hash(self, password: str) -> str:
+        '''Функция для получения хешированного пароля'''
+        return await self._run(_timed_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        '''Функция для верификации пароля'''
+        return await self._run(_timed_verify, plain_password, hashed_password)
+
+    def metrics(self) -> dict:
+        '''Функция для получения метрик пула хеширования'''
+        return {
+            "executor": self.executor_kind,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "in_flight": self.pending,
+            "queue_depth": max(0, self.pending - self.workers),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "hash_seconds_avg": self.hash_seconds_total / self.completed if self.completed else 0.0,
+            "hash_seconds_max": self.hash_seconds_max,
+            "wait_seconds_avg": self.wait_seconds_total / self.completed if self.completed else 0.0,
+        }
+
+    def shutdown(self) -> None:
+        '''Функция для остановки пула'''
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+password_hasher = PasswordHasher(
+    executor=settings.password_hash_executor,
+    workers=settings.password_hash_workers,
+    queue_size=settings.password_hash_queue_size,
+)
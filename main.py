@@ -1,27 +1,125 @@
 ''' main.py'''
 
-from fastapi import FastAPI
-from tortoise.contrib.fastapi import register_tortoise
-import aerich_config
+from contextlib import asynccontextmanager, contextmanager
+import logging
+import time
+from typing import AsyncGenerator
+from fastapi import FastAPI, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import ValidationError
+from tortoise import Tortoise, connections
+from tortoise.exceptions import DoesNotExist, IntegrityError
+from auth import configure_auth
+from cache import configure_employee_caches
+from db import PoolAcquireTimeout, ReadYourWritesMiddleware, tortoise_config
 from router import employee_router
 from router import subdivision_router
 from router import vacation_router
+from router import service_router
+from router import metrics_router
+from hashing import password_hasher
+from metrics import MetricsMiddleware, retire_snapshot
+from orgchart import org_chart
+from repository import Repository
+from scheduler import start_scheduler, stop_scheduler
+from settings import Settings, settings
 
-app = FastAPI(
+logger = logging.getLogger("uvicorn.error")
+
+@contextmanager
+def timed(report: dict, step: str):
+    '''Функция для замера шага старта в миллисекундах'''
+    started = time.perf_counter()
+    yield
+    report[step] = round((time.perf_counter() - started) * 1000, 2)
+
+async def warm_up(app: FastAPI, config: Settings, report: dict) -> None:
+    '''Функция для прогрева воркера до первого запроса'''
+    with timed(report, "db_init_ms"):
+        await Tortoise.init(config=tortoise_config(config=config))
+        if config.db_generate_schemas:
+            await Tortoise.generate_schemas()
+    with timed(report, "pool_open_ms"):
+        for name in connections.db_config:
+            await connections.get(name).create_connection(with_db=True)
+    with timed(report, "warm_up_query_ms"):
+        await Repository.get_collection_version("employees")
+        await Repository.get_all_employees(limit=1)
+    with timed(report, "openapi_ms"):
+        app.openapi()
+    with timed(report, "org_chart_ms"):
+        await Repository.load_org_chart(config.database_url)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
+    '''Функция жизненного цикла: прогрев при старте и освобождение ресурсов при остановке'''
+    config = app.state.settings
+    report = app.state.startup_report
+    with timed(report, "startup_ms"):
+        await warm_up(app, config, report)
+        start_scheduler(config)
+    logger.info("Startup report: %s", report)
+    yield
+    stop_scheduler()
+    if config.metrics_dir:
+        # Итоговые счетчики воркера сворачиваются в retired.json и переживают его замену
+        await retire_snapshot(config.metrics_dir)
+    await org_chart.close()
+    password_hasher.shutdown()
+    await connections.close_all()
+
+async def pool_acquire_timeout_handler(request: Request, exc: PoolAcquireTimeout):
+    '''Функция для ответа 503, если пул соединений исчерпан'''
+    return JSONResponse(status_code=503, content={"detail": "База данных перегружена, повторите позже"})
+
+async def does_not_exist_handler(request: Request, exc: DoesNotExist):
+    '''Функция для ответа 404 на DoesNotExist'''
+    return JSONResponse(status_code=404, content={"detail": str(exc)})
+
+async def integrity_error_handler(request: Request, exc: IntegrityError):
+    '''Функция для ответа 422 на IntegrityError'''
+    return JSONResponse(
+        status_code=422,
+        content={"detail": [{"loc": [], "msg": str(exc), "type": "IntegrityError"}]},
+    )
+
+async def validation_error_handler(request: Request, exc: ValidationError):
+    '''Функция для ответа 422 на проверки схем из Depends(): FastAPI не переводит их в RequestValidationError'''
+    errors = exc.errors(include_url=False, include_context=False)
+    return JSONResponse(status_code=422, content={"detail": jsonable_encoder(errors)})
+
+def create_app(config: Settings = settings) -> FastAPI:
+    '''Функция для сборки приложения: роутеры, middleware, обработчики ошибок и lifespan.
+
+    Запуск: uvicorn main:create_app --factory
+    '''
+    app = FastAPI(
         title="User-Service",
         version="1.0.0",
         description="Сервис для создания и хранения данных о работниках.",
+        lifespan=lifespan,
     )
+    app.state.settings = config
+    # Синглтоны процесса настраиваются из переданной конфигурации, а не из settings по умолчанию
+    configure_auth(config)
+    configure_employee_caches(config)
+    password_hasher.configure(executor=config.password_hash_executor, workers=config.password_hash_workers,
+                              queue_size=config.password_hash_queue_size)
+    # CPU-время процесса до сборки приложения: старт интерпретатора и импорты
+    app.state.startup_report = {"import_cpu_ms": round(time.process_time() * 1000, 2)}
 
-app.include_router(employee_router)
-app.include_router(subdivision_router)
-app.include_router(vacation_router)
-
+    app.include_router(employee_router)
+    app.include_router(subdivision_router)
+    app.include_router(vacation_router)
+    app.include_router(service_router)
+    app.include_router(metrics_router)
+    app.add_middleware(ReadYourWritesMiddleware, window=config.replica_read_your_writes_seconds)
+    # Снаружи остальных middleware, чтобы время запроса учитывало их работу
+    app.add_middleware(MetricsMiddleware)
 
-register_tortoise(
-    app,
-    db_url=aerich_config.DATABASE_URL,
-    modules={"models": ["models"]},
-    generate_schemas=True,
-    add_exception_handlers=True
-    )
+    app.add_exception_handler(PoolAcquireTimeout, pool_acquire_timeout_handler)
+    app.add_exception_handler(DoesNotExist, does_not_exist_handler)
+    app.add_exception_handler(IntegrityError, integrity_error_handler)
+    app.add_exception_handler(ValidationError, validation_error_handler)
+    return app
@@ -0,0 +1,335 @@
+'''metrics.py'''
+
+import asyncio
+import fcntl
+import glob
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import orjson
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UNMATCHED_ROUTE = "<unmatched>"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+ROUTE_COUNTERS = ("requests", "latency_seconds", "queries", "db_seconds", "hash_seconds", "response_bytes")
+
+class RequestStats:
+    '''Класс счетчиков текущего запроса; сам служит оберткой send для учета статуса и размера ответа'''
+    __slots__ = ("send", "status", "response_bytes", "queries", "db_seconds", "hash_seconds", "statements")
+
+    def __init__(self, send):
+        self.send = send
+        # 500, если приложение упало до начала ответа
+        self.status = 500
+        self.response_bytes = 0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.hash_seconds = 0.0
+        # Тексты SQL-запросов, только когда включена запись (бюджеты запросов в тестах)
+        self.statements: Optional[List[str]] = None
+
+    async def __call__(self, message) -> None:
+        if message["type"] == "http.response.start":
+            self.status = message["status"]
+        elif message["type"] == "http.response.body":
+            self.response_bytes += len(message.get("body", b""))
+        await self.send(message)
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+class RouteMetrics:
+    '''Класс накопленных счетчиков одного маршрута (метод + шаблон пути)'''
+    __slots__ = ("buckets", "statuses") + ROUTE_COUNTERS
+
+    def __init__(self):
+        # Некумулятивные счетчики по корзинам, последняя - +Inf
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.statuses: Dict[int, int] = {}
+        self.requests = 0
+        self.latency_seconds = 0.0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.hash_seconds = 0.0
+        self.response_bytes = 0
+
+    def observe(self, stats: RequestStats, seconds: float) -> None:
+        '''Функция для учета завершенного запроса'''
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.statuses[stats.status] = self.statuses.get(stats.status, 0) + 1
+        self.requests += 1
+        self.latency_seconds += seconds
+        self.queries += stats.queries
+        self.db_seconds += stats.db_seconds
+        self.hash_seconds += stats.hash_seconds
+        self.response_bytes += stats.response_bytes
+
+class MetricsRegistry:
+    '''Класс метрик воркера: счетчики по маршрутам и запросы к БД вне HTTP-запросов'''
+
+    def __init__(self):
+        self.routes: Dict[str, Dict[str, RouteMetrics]] = {}
+        self.background_queries = 0
+        self.background_db_seconds = 0.0
+        # Список (запрос, тексты SQL) по каждому HTTP-запросу; None - запись выключена
+        self.traces: Optional[List[Tuple[str, List[str]]]] = None
+        # Уникален для процесса, чтобы снимок нового воркера не затер снимок завершенного с тем же pid
+        self.worker_id = f"{os.getpid()}-{time.time_ns()}"
+        # После сворачивания в retired.json свой снимок больше не пишется, иначе счетчики удвоятся
+        self.retired = False
+
+    def route(self, path: str, method: str) -> RouteMetrics:
+        '''Функция для получения счетчиков маршрута; создаются при первом запросе'''
+        by_method = self.routes.get(path)
+        if by_method is None:
+            by_method = self.routes[path] = {}
+        metrics = by_method.get(method)
+        if metrics is None:
+            metrics = by_method[method] = RouteMetrics()
+        return metrics
+
+    def snapshot(self) -> dict:
+        '''Функция для получения снимка счетчиков в виде, пригодном для JSON и слияния'''
+        routes = []
+        for path, by_method in self.routes.items():
+            for method, metrics in by_method.items():
+                item = {counter: getattr(metrics, counter) for counter in ROUTE_COUNTERS}
+                item.update(route=path, method=method, buckets=list(metrics.buckets),
+                            statuses={str(status): count for status, count in metrics.statuses.items()})
+                routes.append(item)
+        return {
+            "routes": routes,
+            "background_queries": self.background_queries,
+            "background_db_seconds": self.background_db_seconds,
+        }
+
+registry = MetricsRegistry()
+
+def record_query(query: str, seconds: float) -> None:
+    '''Функция для учета SQL-запроса в текущем HTTP-запросе (или в фоновых, если его нет)'''
+    stats = current_request.get()
+    if stats is None:
+        registry.background_queries += 1
+        registry.background_db_seconds += seconds
+    else:
+        stats.queries += 1
+        stats.db_seconds += seconds
+        if stats.statements is not None:
+            stats.statements.append(query)
+
+def record_hash(seconds: float) -> None:
+    '''Функция для учета времени bcrypt (с ожиданием в очереди пула) в текущем HTTP-запросе'''
+    stats = current_request.get()
+    if stats is not None:
+        stats.hash_seconds += seconds
+
+class MetricsMiddleware:
+    '''ASGI-middleware для сбора метрик по шаблону маршрута.
+
+    На запрос создается один RequestStats; маршрут берется из scope["route"], который
+    выставляет роутер FastAPI, поэтому число серий ограничено числом маршрутов.
+    '''
+
+    def __init__(self, app, metrics_registry: Optional[MetricsRegistry] = None):
+        self.app = app
+        self.registry = metrics_registry or registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(send)
+        traces = self.registry.traces
+        if traces is not None:
+            stats.statements = []
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, stats)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path_format", UNMATCHED_ROUTE)
+            self.registry.route(path, scope["method"]).observe(stats, elapsed)
+            if traces is not None:
+                traces.append((f'{scope["method"]} {scope["path"]}', stats.statements))
+
+RETIRED_SNAPSHOT = "retired.json"
+SNAPSHOT_LOCK = ".lock"
+
+@contextmanager
+def _snapshot_lock(directory: str, exclusive: bool = False) -> Iterator[None]:
+    '''Функция для блокировки каталога снимков: чтение разделяемое, сворачивание - исключительное'''
+    with open(os.path.join(directory, SNAPSHOT_LOCK), "ab") as file:
+        fcntl.flock(file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+def _write_file(path: str, data: bytes) -> None:
+    '''Функция для атомарной записи файла через временный файл'''
+    with open(f"{path}.tmp", "wb") as file:
+        file.write(data)
+    os.replace(f"{path}.tmp", path)
+
+def _read_file(path: str) -> Optional[dict]:
+    '''Функция для чтения снимка; None, если файла нет или он поврежден'''
+    try:
+        with open(path, "rb") as file:
+            return orjson.loads(file.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+def _write_own_snapshot(directory: str, metrics_registry: MetricsRegistry, data: bytes) -> None:
+    '''Функция для записи снимка воркера, если он еще не свернут в retired.json'''
+    with _snapshot_lock(directory):
+        if not metrics_registry.retired:
+            _write_file(os.path.join(directory, f"{metrics_registry.worker_id}.json"), data)
+
+def _worker_alive(worker_id: str) -> bool:
+    '''Функция для проверки, жив ли процесс воркера (worker_id начинается с pid)'''
+    try:
+        os.kill(int(worker_id.split("-", 1)[0]), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+async def write_snapshot(directory: str, metrics_registry: Optional[MetricsRegistry] = None) -> None:
+    '''Функция для записи снимка счетчиков воркера в общий каталог.
+
+    Снимок берется в цикле событий, где счетчики и меняются, в потоке выполняется только запись.
+    '''
+    metrics_registry = metrics_registry or registry
+    data = orjson.dumps(metrics_registry.snapshot())
+    await asyncio.to_thread(_write_own_snapshot, directory, metrics_registry, data)
+
+def _fold_retired(directory: str, snapshot: dict, worker_id: str) -> None:
+    '''Функция для сворачивания снимков завершенных воркеров в retired.json под блокировкой'''
+    retired_path = os.path.join(directory, RETIRED_SNAPSHOT)
+    with _snapshot_lock(directory, exclusive=True):
+        parts = [_read_file(retired_path), snapshot]
+        folded = []
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            if path == retired_path:
+                continue
+            name = os.path.basename(path)[:-len(".json")]
+            # Свой файл устарел: вместо него берется снимок из памяти
+            if name == worker_id:
+                folded.append(path)
+            elif not _worker_alive(name):
+                parts.append(_read_file(path))
+                folded.append(path)
+        _write_file(retired_path, orjson.dumps(merge_snapshots(part for part in parts if part)))
+        for path in folded:
+            os.remove(path)
+
+async def retire_snapshot(directory: str, metrics_registry: Optional[MetricsRegistry] = None) -> None:
+    '''Функция для переноса итоговых счетчиков останавливающегося воркера в retired.json.
+
+    Заодно сворачиваются файлы воркеров, чьих процессов уже нет, поэтому при замене воркеров
+    по max_requests число читаемых при каждом /metrics файлов не растет.
+    '''
+    metrics_registry = metrics_registry or registry
+    # Флаг ставится до блокировки: запись, начатая раньше, закончится до сворачивания, поздняя - не начнется
+    metrics_registry.retired = True
+    await asyncio.to_thread(_fold_retired, directory, metrics_registry.snapshot(), metrics_registry.worker_id)
+
+def read_snapshots(directory: str, exclude: Optional[str] = None) -> List[dict]:
+    '''Функция для чтения снимков работающих воркеров и свернутых завершенных'''
+    with _snapshot_lock(directory):
+        snapshots = []
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            if exclude and os.path.basename(path) == f"{exclude}.json":
+                continue
+            snapshot = _read_file(path)
+            if snapshot is not None:
+                snapshots.append(snapshot)
+        return snapshots
+
+def clear_snapshots(directory: str) -> None:
+    '''Функция для очистки каталога снимков перед запуском воркеров'''
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "*.json*")):
+        os.remove(path)
+
+def merge_snapshots(snapshots: Iterable[dict]) -> dict:
+    '''Функция для суммирования снимков нескольких воркеров'''
+    routes: Dict[tuple, dict] = {}
+    merged = {"routes": [], "background_queries": 0, "background_db_seconds": 0.0}
+    for snapshot in snapshots:
+        merged["background_queries"] += snapshot["background_queries"]
+        merged["background_db_seconds"] += snapshot["background_db_seconds"]
+        for item in snapshot["routes"]:
+            key = (item["route"], item["method"])
+            total = routes.get(key)
+            if total is None:
+                total = routes[key] = {**item, "buckets": list(item["buckets"]), "statuses": dict(item["statuses"])}
+                merged["routes"].append(total)
+                continue
+            for counter in ROUTE_COUNTERS:
+                total[counter] += item[counter]
+            total["buckets"] = [left + right for left, right in zip(total["buckets"], item["buckets"])]
+            for status, count in item["statuses"].items():
+                total["statuses"][status] = total["statuses"].get(status, 0) + count
+    return merged
+
+async def collect(directory: Optional[str] = None) -> dict:
+    '''Функция для получения метрик: своего воркера или, при общем каталоге, всех воркеров'''
+    if not directory:
+        return registry.snapshot()
+    # Свои счетчики берутся из памяти, снимки остальных отстают не больше чем на период сброса
+    snapshot = registry.snapshot()
+    others = await asyncio.to_thread(read_snapshots, directory, registry.worker_id)
+    return merge_snapshots([snapshot, *others])
+
+def _label(value: str) -> str:
+    '''Функция для экранирования значения метки Prometheus'''
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render(snapshot: dict) -> str:
+    '''Функция для вывода снимка в текстовом формате Prometheus'''
+    routes = sorted(snapshot["routes"], key=lambda item: (item["route"], item["method"]))
+    labels = [f'method="{_label(item["method"])}",route="{_label(item["route"])}"' for item in routes]
+    lines = [
+        "# HELP http_request_duration_seconds Request latency by route template.",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for item, label in zip(routes, labels):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), item["buckets"]):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'http_request_duration_seconds_bucket{{{label},le="{le}"}} {cumulative}')
+        lines.append(f"http_request_duration_seconds_sum{{{label}}} {item['latency_seconds']!r}")
+        lines.append(f"http_request_duration_seconds_count{{{label}}} {item['requests']}")
+
+    lines += ["# HELP http_requests_total Requests by route template and status.",
+              "# TYPE http_requests_total counter"]
+    for item, label in zip(routes, labels):
+        for status, count in sorted(item["statuses"].items()):
+            lines.append(f'http_requests_total{{{label},status="{status}"}} {count}')
+
+    counters = (
+        ("http_request_db_queries_total", "SQL statements executed while serving the route.", "queries"),
+        ("http_request_db_seconds_total", "Time spent in SQL statements, including pool acquire.", "db_seconds"),
+        ("http_request_password_hash_seconds_total", "Time spent in bcrypt, including executor queue.",
+         "hash_seconds"),
+        ("http_response_size_bytes_total", "Response body bytes sent.", "response_bytes"),
+    )
+    for name, help_text, counter in counters:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for item, label in zip(routes, labels):
+            lines.append(f"{name}{{{label}}} {item[counter]!r}")
+
+    lines += [
+        "# HELP db_background_queries_total SQL statements executed outside HTTP requests.",
+        "# TYPE db_background_queries_total counter",
+        f"db_background_queries_total {snapshot['background_queries']}",
+        "# HELP db_background_seconds_total Time spent in SQL statements outside HTTP requests.",
+        "# TYPE db_background_seconds_total counter",
+        f"db_background_seconds_total {snapshot['background_db_seconds']!r}",
+    ]
+    return "\n".join(lines) + "\n"
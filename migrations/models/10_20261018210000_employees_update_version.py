@@ -0,0 +1,28 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE OR REPLACE FUNCTION bump_collection_version_if_changed() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM "changed") THEN
+        INSERT INTO "collection_changes" ("name") VALUES (TG_ARGV[0]);
+    END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS "employees_version" ON "employees";
+CREATE TRIGGER "employees_version" AFTER INSERT OR DELETE OR TRUNCATE ON "employees"
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_collection_version('employees');
+DROP TRIGGER IF EXISTS "employees_update_version" ON "employees";
+CREATE TRIGGER "employees_update_version" AFTER UPDATE ON "employees"
+    REFERENCING NEW TABLE AS "changed"
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_collection_version_if_changed('employees');"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TRIGGER IF EXISTS "employees_update_version" ON "employees";
+DROP TRIGGER IF EXISTS "employees_version" ON "employees";
+CREATE TRIGGER "employees_version" AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "employees"
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_collection_version('employees');
+DROP FUNCTION IF EXISTS bump_collection_version_if_changed();"""
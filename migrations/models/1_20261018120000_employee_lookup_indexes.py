@@ -0,0 +1,15 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE INDEX IF NOT EXISTS "idx_employees_lower_login" ON "employees" (LOWER("login"));
+CREATE INDEX IF NOT EXISTS "idx_employees_lower_email" ON "employees" (LOWER("email"));
+CREATE INDEX IF NOT EXISTS "idx_employees_lower_name" ON "employees" (LOWER("last_name"), LOWER("first_name"), LOWER("patronymic"));"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP INDEX IF EXISTS "idx_employees_lower_login";
+DROP INDEX IF EXISTS "idx_employees_lower_email";
+DROP INDEX IF EXISTS "idx_employees_lower_name";"""
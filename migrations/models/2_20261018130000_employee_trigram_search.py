@@ -0,0 +1,12 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS "idx_employees_search_trgm" ON "employees" USING GIN ((LOWER(COALESCE("last_name", '') || ' ' || COALESCE("first_name", '') || ' ' || COALESCE("patronymic", '') || ' ' || COALESCE("login", '') || ' ' || COALESCE("email", ''))) gin_trgm_ops);"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP INDEX IF EXISTS "idx_employees_search_trgm";"""
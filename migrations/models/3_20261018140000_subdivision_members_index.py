@@ -0,0 +1,13 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE INDEX IF NOT EXISTS "idx_subdivisions_employees_subdivision" ON "subdivisions_employees" ("subdivisions_id", "employees_id");
+CREATE INDEX IF NOT EXISTS "idx_subdivisions_employees_employee" ON "subdivisions_employees" ("employees_id");"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP INDEX IF EXISTS "idx_subdivisions_employees_subdivision";
+DROP INDEX IF EXISTS "idx_subdivisions_employees_employee";"""
@@ -0,0 +1,37 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "collection_versions" (
+    "name" VARCHAR(32) NOT NULL PRIMARY KEY,
+    "version" BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO "collection_versions" ("name") VALUES ('employees'), ('subdivisions'), ('vacations') ON CONFLICT DO NOTHING;
+CREATE OR REPLACE FUNCTION bump_collection_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE "collection_versions" SET "version" = "version" + 1 WHERE "name" = TG_ARGV[0];
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS "employees_version" ON "employees";
+CREATE TRIGGER "employees_version" AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "employees"
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_collection_version('employees');
+DROP TRIGGER IF EXISTS "subdivisions_version" ON "subdivisions";
+CREATE TRIGGER "subdivisions_version" AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "subdivisions"
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_collection_version('subdivisions');
+DROP TRIGGER IF EXISTS "subdivisions_employees_version" ON "subdivisions_employees";
+CREATE TRIGGER "subdivisions_employees_version" AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "subdivisions_employees"
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_collection_version('subdivisions');
+DROP TRIGGER IF EXISTS "vacations_version" ON "vacations";
+CREATE TRIGGER "vacations_version" AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "vacations"
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_collection_version('vacations');"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DROP TRIGGER IF EXISTS "employees_version" ON "employees";
+DROP TRIGGER IF EXISTS "subdivisions_version" ON "subdivisions";
+DROP TRIGGER IF EXISTS "subdivisions_employees_version" ON "subdivisions_employees";
+DROP TRIGGER IF EXISTS "vacations_version" ON "vacations";
+DROP FUNCTION IF EXISTS bump_collection_version();
+DROP TABLE IF EXISTS "collection_versions";"""
@@ -0,0 +1,53 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE EXTENSION IF NOT EXISTS btree_gist;
+DO $$
+DECLARE
+    conflicts TEXT;
+    reversed TEXT;
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'vacations_no_overlap') THEN
+        -- Перевернутый период не дает построить daterange ни в проверке ниже, ни в ограничении
+        SELECT string_agg(format('%s (%s > %s)', r.id, r.start_date, r.end_date), '; ')
+        INTO reversed
+        FROM (SELECT "id", "start_date", "end_date" FROM "vacations"
+              WHERE "start_date" > "end_date"
+              ORDER BY 1
+              LIMIT 20) r;
+        IF reversed IS NOT NULL THEN
+            RAISE EXCEPTION 'Cannot add vacations_no_overlap, vacation ids with start_date after end_date (first 20): %', reversed
+                USING HINT = 'Fix or delete these vacations and rerun the migration; '
+                             'list all of them with: SELECT id, employee_id, start_date, end_date FROM vacations '
+                             'WHERE start_date > end_date';
+        END IF;
+        -- Существующие пересечения не дадут создать ограничение; перечисляем их до ALTER
+        SELECT string_agg(format('employee %s: %s and %s', p.employee_id, p.first_id, p.second_id), '; ')
+        INTO conflicts
+        FROM (SELECT a.employee_id, a.id AS first_id, b.id AS second_id
+              FROM "vacations" a
+              JOIN "vacations" b ON b.employee_id = a.employee_id AND b.id > a.id
+                  AND daterange(a.start_date, a.end_date, '[]') && daterange(b.start_date, b.end_date, '[]')
+              WHERE a.start_date IS NOT NULL AND a.end_date IS NOT NULL
+                  AND b.start_date IS NOT NULL AND b.end_date IS NOT NULL
+              ORDER BY 1, 2, 3
+              LIMIT 20) p;
+        IF conflicts IS NOT NULL THEN
+            RAISE EXCEPTION 'Cannot add vacations_no_overlap, overlapping vacation ids (first 20): %', conflicts
+                USING HINT = 'Shorten or delete one vacation of each pair and rerun the migration; '
+                             'list all pairs with: SELECT a.employee_id, a.id, b.id FROM vacations a '
+                             'JOIN vacations b ON b.employee_id = a.employee_id AND b.id > a.id '
+                             'AND daterange(a.start_date, a.end_date, ''[]'') && daterange(b.start_date, b.end_date, ''[]'')';
+        END IF;
+        ALTER TABLE "vacations" ADD CONSTRAINT "vacations_no_overlap"
+            EXCLUDE USING gist ("employee_id" WITH =, daterange("start_date", "end_date", '[]') WITH &&)
+            WHERE ("start_date" IS NOT NULL AND "end_date" IS NOT NULL);
+    END IF;
+END $$;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE "vacations" DROP CONSTRAINT IF EXISTS "vacations_no_overlap";"""
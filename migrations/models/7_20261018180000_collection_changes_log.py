@@ -0,0 +1,27 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        CREATE TABLE IF NOT EXISTS "collection_changes" (
+    "name" VARCHAR(32) NOT NULL
+);
+CREATE INDEX IF NOT EXISTS "idx_collection_changes_name" ON "collection_changes" ("name");
+CREATE OR REPLACE FUNCTION bump_collection_version() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO "collection_changes" ("name") VALUES (TG_ARGV[0]);
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        UPDATE "collection_versions" v SET "version" = v."version" + c."count"
+    FROM (SELECT "name", count(*) AS "count" FROM "collection_changes" GROUP BY "name") c
+    WHERE v."name" = c."name";
+CREATE OR REPLACE FUNCTION bump_collection_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE "collection_versions" SET "version" = "version" + 1 WHERE "name" = TG_ARGV[0];
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+DROP TABLE IF EXISTS "collection_changes";"""
@@ -0,0 +1,18 @@
+from tortoise import BaseDBAsyncClient
+
+
+async def upgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'vacations_dates_order') THEN
+        -- NOT VALID: старые перевернутые записи не мешают миграции, новые и обновленные проверяются
+        ALTER TABLE "vacations" ADD CONSTRAINT "vacations_dates_order"
+            CHECK ("start_date" <= "end_date") NOT VALID;
+    END IF;
+END $$;"""
+
+
+async def downgrade(db: BaseDBAsyncClient) -> str:
+    return """
+        ALTER TABLE "vacations" DROP CONSTRAINT IF EXISTS "vacations_dates_order";"""
@@ -0,0 +1,206 @@
+'''orgchart.py'''
+
+import asyncio
+import json
+import logging
+from array import array
+from bisect import bisect_right, insort
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+import asyncpg
+
+ORG_CHART_CHANNEL = "org_chart"
+RECONNECT_MAX_DELAY = 30.0
+
+logger = logging.getLogger("uvicorn.error")
+
+class OrgChart:
+    '''Класс снимка подразделений в памяти: id -> (name, leader_id, отсортированные id работников)
+
+    Строится один раз при старте, дальше патчится сообщениями от записей в Repository.
+    Сообщения идемпотентны и рассылаются остальным воркерам через NOTIFY.
+    '''
+    def __init__(self):
+        self.loaded = False
+        self._ids = array('l')
+        self._names: Dict[int, Optional[str]] = {}
+        self._leaders: Dict[int, Optional[int]] = {}
+        self._members: Dict[int, array] = {}
+        self._listener: Optional[asyncpg.Connection] = None
+        self._pending: Optional[List[dict]] = None
+        self._reload: Optional[Callable[[], Awaitable[None]]] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+
+    def replace(self, rows: Iterable[dict]) -> None:
+        '''Функция для полной пересборки снимка из строк БД'''
+        self._ids = array('l')
+        self._names, self._leaders, self._members = {}, {}, {}
+        for row in sorted(rows, key=lambda item: item['id']):
+            self._ids.append(row['id'])
+            self._names[row['id']] = row['name']
+            self._leaders[row['id']] = row['leader_id']
+            self._members[row['id']] = array('l', sorted(row['employee_ids']))
+        self.loaded = True
+        # Патчи, пришедшие во время загрузки, догоняем после пересборки
+        pending, self._pending = self._pending or [], None
+        for message in pending:
+            self.apply(message)
+
+    def _row(self, subdivision_id: int, counts_only: bool = False) -> dict:
+        '''Функция для сборки строки ответа по подразделению'''
+        row = {
+            'id': subdivision_id,
+            'name': self._names[subdivision_id],
+            'leader_id': self._leaders[subdivision_id],
+        }
+        members = self._members[subdivision_id]
+        if counts_only:
+            row['employee_count'] = len(members)
+        else:
+            row['employee_ids'] = members.tolist()
+        return row
+
+    def page(self, after: Optional[int] = None, limit: Optional[int] = None,
+             counts_only: bool = False) -> List[dict]:
+        '''Функция для получения страницы подразделений по id'''
+        start = bisect_right(self._ids, after) if after is not None else 0
+        stop = start + limit if limit is not None else len(self._ids)
+        return [self._row(subdivision_id, counts_only) for subdivision_id in self._ids[start:stop]]
+
+    def get(self, subdivision_id: int) -> Optional[dict]:
+        '''Функция для получения одного подразделения'''
+        if subdivision_id not in self._names:
+            return None
+        return self._row(subdivision_id)
+
+    def apply(self, message: dict) -> None:
+        '''Функция для применения патча к снимку'''
+        if not self.loaded:
+            if self._pending is not None:
+                self._pending.append(message)
+            return
+        op = message['op']
+        subdivision_id = message.get('id')
+        if op == 'put':
+            if subdivision_id not in self._names:
+                insort(self._ids, subdivision_id)
+                self._members[subdivision_id] = array('l')
+            self._names[subdivision_id] = message['name']
+            self._leaders[subdivision_id] = message['leader_id']
+        elif op == 'drop':
+            self._drop(subdivision_id)
+        elif op == 'drop_employee':
+            employee_id = message['employee_id']
+            # subdivisions.leader_id объявлен с ON DELETE CASCADE
+            for led in [key for key, leader in self._leaders.items() if leader == employee_id]:
+                self._drop(led)
+            for members in self._members.values():
+                self._remove_member(members, employee_id)
+        elif subdivision_id in self._names:
+            if op == 'rename':
+                self._names[subdivision_id] = message['name']
+            elif op == 'set_leader':
+                self._leaders[subdivision_id] = message['leader_id']
+            elif op == 'add_member':
+                members = self._members[subdivision_id]
+                position = bisect_right(members, message['employee_id'])
+                if not position or members[position - 1] != message['employee_id']:
+                    members.insert(position, message['employee_id'])
+            elif op == 'remove_member':
+                self._remove_member(self._members[subdivision_id], message['employee_id'])
+
+    def _drop(self, subdivision_id: int) -> None:
+        '''Функция для удаления подразделения из снимка'''
+        if subdivision_id in self._names:
+            del self._ids[bisect_right(self._ids, subdivision_id) - 1]
+            del self._names[subdivision_id], self._leaders[subdivision_id], self._members[subdivision_id]
+
+    @staticmethod
+    def _remove_member(members: array, employee_id: int) -> None:
+        '''Функция для удаления работника из отсортированного массива'''
+        position = bisect_right(members, employee_id)
+        if position and members[position - 1] == employee_id:
+            del members[position - 1]
+
+    def diff(self, rows: Iterable[dict]) -> dict:
+        '''Функция для сравнения снимка со строками БД'''
+        expected = {row['id']: row for row in rows}
+        missing = sorted(set(expected) - set(self._names))
+        extra = sorted(set(self._names) - set(expected))
+        mismatched = sorted(
+            subdivision_id for subdivision_id in set(expected) & set(self._names)
+            if self._row(subdivision_id) != {**expected[subdivision_id],
+                                             'employee_ids': sorted(expected[subdivision_id]['employee_ids'])}
+        )
+        return {
+            'loaded': self.loaded,
+            'consistent': not (missing or extra or mismatched),
+            'subdivisions': len(self._names),
+            'missing': missing,
+            'extra': extra,
+            'mismatched': mismatched,
+        }
+
+    async def listen(self, dsn: str, reload: Optional[Callable[[], Awaitable[None]]] = None,
+                     subscriptions: Optional[Dict[str, Callable[[dict], None]]] = None) -> None:
+        '''Функция для подписки на патчи от других воркеров.
+
+        reload вызывается после разрыва соединения подписки: он должен заново подписаться
+        и пересобрать снимок (патчи за время разрыва потеряны). subscriptions - другие каналы
+        с JSON-сообщениями на том же соединении (канал -> обработчик).
+        '''
+        if not self.loaded:
+            self._pending = []
+        self._reload = reload
+        self._listener = await asyncpg.connect(dsn)
+        self._listener.add_termination_listener(self._on_listener_lost)
+        await self._listener.add_listener(
+            ORG_CHART_CHANNEL, lambda *args: self.apply(json.loads(args[-1])))
+        for channel, handler in (subscriptions or {}).items():
+            await self._listener.add_listener(
+                channel, lambda *args, handler=handler: handler(json.loads(args[-1])))
+
+    def _on_listener_lost(self, connection: asyncpg.Connection) -> None:
+        '''Функция-обработчик разрыва подписки: снимок отключается, чтения идут в SQL до пересборки'''
+        if connection is not self._listener:
+            return
+        logger.warning("Org chart listener connection lost, falling back to SQL")
+        self._listener = None
+        self.loaded = False
+        self._pending = None
+        if self._reload is not None and self._reconnect_task is None:
+            self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        '''Функция для повторной подписки и пересборки снимка с растущей паузой между попытками'''
+        delay = 0.5
+        try:
+            while self._reload is not None:
+                try:
+                    await self._reload()
+                    logger.info("Org chart listener reconnected, snapshot rebuilt")
+                    return
+                except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as error:
+                    logger.warning("Org chart reconnect failed: %s; retrying in %.1f s", error, delay)
+                    await self._drop_listener()
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        finally:
+            self._reconnect_task = None
+
+    async def _drop_listener(self) -> None:
+        '''Функция для закрытия соединения подписки без срабатывания переподключения'''
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            await listener.close()
+
+    async def close(self) -> None:
+        '''Функция для отписки от патчей; без подписки снимок отключается'''
+        self._reload = None
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        await self._drop_listener()
+        self.loaded = False
+        self._pending = None
+
+org_chart = OrgChart()
@@ -1,23 +1,286 @@
 '''repository.py'''
 
-from typing import List, Optional
-from pydantic import BaseModel
-from tortoise.exceptions import DoesNotExist
+from datetime import date
+import json
+import time
+from typing import AsyncIterator, List, Optional, Sequence
+from pydantic import BaseModel, ValidationError
+from tortoise import connections
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.exceptions import IntegrityError
+from tortoise.expressions import Q
+from tortoise.functions import Lower
+from tortoise.queryset import QuerySet
+from tortoise.transactions import in_transaction
 from schemas import EmployeeAdd, EmployeeUpdate, Subdivision, VacationAdd
-from schemas import VacationUpdate
+from schemas import VacationUpdate, EMPLOYEE_LIST_FIELDS
 from models import Employees, Subdivisions, Vacations
+from cache import EMPLOYEE_CACHE_CHANNEL, REVOKED_TOKENS_CHANNEL, add_revoked_tokens, drop_employees
+from cache import employees_by_id, employees_by_login
+from db import read_connection, read_connection_name
+from metrics import record_query
+from orgchart import ORG_CHART_CHANNEL, org_chart
+from settings import settings
+
+# Больше работников за раз - сброс всего кеша: payload NOTIFY ограничен 8000 байт
+EMPLOYEE_CACHE_NOTIFY_LIMIT = 100
+VACATION_EXPORT_COLUMNS = ('id', 'employee_id', 'type', 'start_date', 'end_date')
+VACATION_EXPORT_BATCH_SIZE = 1000
+EMPLOYEE_BULK_CHUNK_SIZE = 1000
+EMPLOYEE_BULK_COLUMNS = tuple(EmployeeAdd.model_fields)
+# Новый работник без отпусков, поэтому is_vacation всегда 'no'
+EMPLOYEE_BULK_INSERT_SQL = (
+    f'INSERT INTO "employees" ({", ".join(EMPLOYEE_BULK_COLUMNS)}, "is_vacation") '
+    f'SELECT *, \'no\' FROM unnest({", ".join(f"${i}::varchar[]" for i in range(1, len(EMPLOYEE_BULK_COLUMNS) + 1))}) '
+    'RETURNING "id"'
+)
+# Выражение должно совпадать с индексом idx_employees_search_trgm из миграции
+EMPLOYEE_SEARCH_TEXT = (
+    "LOWER(COALESCE(last_name, '') || ' ' || COALESCE(first_name, '') || ' ' || "
+    "COALESCE(patronymic, '') || ' ' || COALESCE(login, '') || ' ' || COALESCE(email, ''))"
+)
+EMPLOYEE_FUZZY_SEARCH_SQL = (
+    f'SELECT {", ".join(EMPLOYEE_LIST_FIELDS)}, "password" FROM "employees" '
+    f'WHERE LOWER($1) <% {EMPLOYEE_SEARCH_TEXT} '
+    f'ORDER BY word_similarity(LOWER($1), {EMPLOYEE_SEARCH_TEXT}) DESC, "id" LIMIT $2'
+)
+SUBDIVISION_MEMBERS_AGG = {
+    'employee_ids': ("COALESCE(array_agg(se.employees_id ORDER BY se.employees_id) "
+                     "FILTER (WHERE se.employees_id IS NOT NULL), '{}') AS employee_ids"),
+    'employee_count': 'count(se.employees_id) AS employee_count',
+}
+SUBDIVISION_MEMBERS_SQL = (
+    'SELECT s.id, s.name, s.leader_id, {members} FROM ({subdivisions}) AS s '
+    'LEFT JOIN "subdivisions_employees" se ON se.subdivisions_id = s.id '
+    'GROUP BY s.id, s.name, s.leader_id ORDER BY s.id'
+)
+SUBDIVISION_PAGE_SQL = (
+    'SELECT id, name, leader_id FROM "subdivisions" '
+    'WHERE ($1::int IS NULL OR id > $1) ORDER BY id LIMIT $2'
+)
+VACATION_BULK_CHUNK_SIZE = 5000
+# Совпадает с выражением ограничения vacations_no_overlap (EXCLUDE USING gist)
+VACATION_DATERANGE = "daterange({table}.start_date, {table}.end_date, '[]')"
+VACATION_OVERLAP_CONSTRAINT = 'vacations_no_overlap'
+VACATION_RETURNING = 'RETURNING "id", "employee_id", "start_date", "end_date", "type"'
+# Флаг is_vacation = 'yes', если у работника есть отпуск или командировка, покрывающие $1
+EMPLOYEE_VACATION_FLAG_SQL = (
+    'UPDATE "employees" e SET "is_vacation" = f.flag FROM ('
+    'SELECT e2.id, CASE WHEN EXISTS (SELECT 1 FROM "vacations" v WHERE v.employee_id = e2.id '
+    'AND v.start_date IS NOT NULL AND v.end_date IS NOT NULL '
+    f'AND {VACATION_DATERANGE.format(table="v")} @> $1::date) '
+    'THEN \'yes\' ELSE \'no\' END AS flag FROM "employees" e2 {where}) AS f '
+    'WHERE e.id = f.id AND e.is_vacation IS DISTINCT FROM f.flag RETURNING e.id, e.login'
+)
+
+def notify_employee_changes(statement: str, keys: str = 'SELECT id, login FROM changed') -> str:
+    '''Функция для оборачивания записи в работников: тот же запрос рассылает сброс кеша остальным воркерам.
+
+    statement - UPDATE/DELETE с RETURNING, keys - выборка пар (id, login) из его строк (CTE changed).
+    Сообщение уходит только если строки есть; при большом числе строк - сброс всего кеша.
+    '''
+    return (
+        f'WITH changed AS ({statement}), notified AS ('
+        f"SELECT pg_notify('{EMPLOYEE_CACHE_CHANNEL}', CASE WHEN count(*) > {EMPLOYEE_CACHE_NOTIFY_LIMIT} "
+        "THEN '{\"clear\": true}' ELSE json_build_object('employees', "
+        f'json_agg(json_build_array(k.id, k.login)))::text END) FROM ({keys}) AS k HAVING count(*) > 0) '
+        'SELECT changed.* FROM changed CROSS JOIN notified'
+    )
+
+# Отзыв сохраняется для воркеров, которые стартуют позже, и рассылается работающим; истекшие чистятся
+REVOKE_TOKEN_SQL = (
+    'WITH "purged" AS (DELETE FROM "revoked_tokens" WHERE "expires_at" <= now()), '
+    '"stored" AS (INSERT INTO "revoked_tokens" ("jti", "expires_at") '
+    'VALUES ($1::text, to_timestamp($2::float8)) ON CONFLICT DO NOTHING) '
+    f"SELECT pg_notify('{REVOKED_TOKENS_CHANNEL}', json_build_object("
+    "'tokens', json_build_array(json_build_array($1::text, $2::float8)))::text)"
+)
+REVOKED_TOKENS_SQL = (
+    'SELECT "jti", extract(epoch FROM "expires_at")::float8 AS "exp" '
+    'FROM "revoked_tokens" WHERE "expires_at" > now()'
+)
+
+# Отпуска агрегируются по работнику в LATERAL; NULL-агрегат значит, что подходящих записей нет
+EMPLOYEE_VACATIONS_SEARCH_SQL = (
+    'SELECT e.id, e.last_name, e.first_name, e.patronymic, e.email, e.login, e.password, v.vacations '
+    'FROM "employees" e CROSS JOIN LATERAL ('
+    'SELECT json_agg(json_build_object(\'id\', v.id, \'employee_id\', v.employee_id, '
+    '\'start_date\', v.start_date, \'end_date\', v.end_date, \'type\', v.type) '
+    'ORDER BY v.start_date, v.id) AS vacations FROM "vacations" v WHERE v.employee_id = e.id '
+    'AND ($2::varchar IS NULL OR v.type = $2) '
+    'AND ($3::date IS NULL OR v.end_date >= $3) AND ($4::date IS NULL OR v.start_date <= $4)'
+    ') v WHERE v.vacations IS NOT NULL AND ($1::int IS NULL OR e.id = $1) '
+    'AND ($5::int IS NULL OR e.id > $5) ORDER BY e.id LIMIT $6'
+)
+# Строки пачки с несуществующим работником (unknown) или пересечением с уже сохраненными отпусками
+VACATION_BULK_CHECK_SQL = (
+    'SELECT i.ord, NOT EXISTS (SELECT 1 FROM "employees" e WHERE e.id = i.employee_id) AS unknown '
+    'FROM unnest($1::int[], $2::date[], $3::date[], $4::int[]) AS i(employee_id, start_date, end_date, ord) '
+    'WHERE NOT EXISTS (SELECT 1 FROM "employees" e WHERE e.id = i.employee_id) '
+    'OR EXISTS (SELECT 1 FROM "vacations" v WHERE v.employee_id = i.employee_id '
+    f'AND {VACATION_DATERANGE.format(table="v")} && daterange(i.start_date, i.end_date, \'[]\') '
+    'AND v.start_date IS NOT NULL AND v.end_date IS NOT NULL)'
+)
+VACATION_BULK_INSERT_SQL = (
+    'INSERT INTO "vacations" ("employee_id", "start_date", "end_date", "type") '
+    'SELECT * FROM unnest($1::int[], $2::date[], $3::date[], $4::varchar[]) '
+    'ON CONFLICT DO NOTHING RETURNING "employee_id", "start_date"'
+)
+# Отсутствия подразделения за период одной строкой массивов, в порядке работника и начала
+SUBDIVISION_ABSENCES_SQL = (
+    'SELECT array_agg(a.employee_id) AS employee_ids, array_agg(a.business) AS business, '
+    'array_agg(a.start_day) AS starts, array_agg(a.end_day) AS ends FROM ('
+    'SELECT v.employee_id, v.type = \'business\' AS business, '
+    'GREATEST(v.start_date, $2) - $2 AS start_day, LEAST(v.end_date, $3) - $2 AS end_day '
+    'FROM "vacations" v WHERE v.employee_id = ANY($1::int[]) '
+    'AND v.start_date IS NOT NULL AND v.end_date IS NOT NULL '
+    f'AND {VACATION_DATERANGE.format(table="v")} && daterange($2, $3, \'[]\') '
+    'ORDER BY v.employee_id, v.start_date) a'
+)
+# Записи только вставляют строки в журнал и не блокируют друг друга; строка видна вместе
+# с данными после COMMIT, поэтому версия не опережает данные и одинакова на реплике
+COLLECTION_VERSION_SQL = (
+    'SELECT v."version" + (SELECT count(*) FROM "collection_changes" c WHERE c."name" = v."name") '
+    'AS "version" FROM "collection_versions" v WHERE v."name" = $1'
+)
+# Удаление и прибавка к базе в одном запросе, поэтому сумма для читателей не меняется;
+# advisory-блокировка не дает двум воркерам сворачивать журнал одновременно
+COMPACT_COLLECTION_CHANGES_SQL = (
+    'WITH "lock" AS (SELECT pg_try_advisory_xact_lock(hashtext(\'collection_changes\')) AS "ok"), '
+    '"moved" AS (DELETE FROM "collection_changes" WHERE (SELECT "ok" FROM "lock") RETURNING "name") '
+    'UPDATE "collection_versions" v SET "version" = v."version" + m."count" '
+    'FROM (SELECT "name", count(*) AS "count" FROM "moved" GROUP BY "name") m WHERE v."name" = m."name"'
+)
+
+
+def vacation_covers(start_date: Optional[date], end_date: Optional[date], day: date) -> bool:
+    '''Функция для проверки, что период отпуска покрывает день: только такие записи меняют is_vacation'''
+    return start_date is not None and end_date is not None and start_date <= day <= end_date
+
+
+def find_vacation_overlaps(vacations: Sequence[tuple]) -> dict:
+    '''Функция для поиска пересечений внутри пачки (row, VacationAdd) проходом по отсортированным датам.
+
+    Возвращает {row: row пересекающейся записи}; при пересечении остается более ранняя запись.
+    '''
+    conflicts = {}
+    ordered = sorted(vacations, key=lambda item: (item[1].employee_id, item[1].start_date, item[0]))
+    last_employee, last_end, last_row = None, None, None
+    for row, vacation in ordered:
+        if vacation.employee_id == last_employee and vacation.start_date <= last_end:
+            conflicts[row] = last_row
+            continue
+        last_employee, last_end, last_row = vacation.employee_id, vacation.end_date, row
+    return conflicts
 
 class Repository(BaseModel):
     '''Класс функций для роутера'''
     @classmethod
-    async def get_all_employees(cls):
-        '''Функция для получения списка всех работников'''
-        return await Employees.all()
+    async def get_all_employees(
+        cls,
+        after: Optional[int] = None,
+        limit: Optional[int] = None,
+        fields: Optional[Sequence[str]] = None,
+    ) -> List[dict]:
+        '''Функция для получения страницы работников (keyset по id).
+
+        Строки читаются через values() без создания моделей Tortoise,
+        limit=None возвращает все строки после курсора.
+        '''
+        query = Employees.all().using_db(read_connection()).order_by('id')
+        if after is not None:
+            query = query.filter(id__gt=after)
+        if limit is not None:
+            query = query.limit(limit)
+        return await query.values(*(fields or EMPLOYEE_LIST_FIELDS))
     
     @classmethod
-    async def get_employee_by_id(cls, user_id: int):
-        '''Функция для получения работника по ID'''
-        return await Employees.get_or_none(id=user_id)
+    async def get_collection_version(cls, name: str) -> int:
+        '''Функция для получения версии коллекции (employees, subdivisions, vacations)
+
+        Триггеры на таблицах добавляют строку в collection_changes при любой записи, включая
+        каскады и bulk-вставки (UPDATE работников - только если строки есть); версия - свернутая база плюс число еще не свернутых строк.
+        '''
+        rows = await read_connection().execute_query_dict(COLLECTION_VERSION_SQL, [name])
+        return rows[0]['version'] if rows else 0
+
+    @classmethod
+    async def compact_collection_versions(cls) -> None:
+        '''Функция для сворачивания журнала collection_changes в collection_versions (версии не меняются)'''
+        await connections.get('default').execute_query(COMPACT_COLLECTION_CHANGES_SQL)
+
+    @classmethod
+    async def get_employee_by_id(cls, user_id: int) -> Optional[Employees]:
+        '''Функция для получения работника по ID через кеш'''
+        employee = employees_by_id.get(user_id)
+        if employee is None:
+            employee = await Employees.get_or_none(id=user_id)
+            if employee is not None:
+                cls._cache_employee(employee)
+        return employee
+
+    @classmethod
+    def _cache_employee(cls, employee: Employees) -> None:
+        '''Функция для записи работника в кеши по id и логину'''
+        employees_by_id.set(employee.id, employee)
+        if employee.login:
+            employees_by_login.set(employee.login.lower(), employee)
+
+    @classmethod
+    def invalidate_employee(cls, *employees: Employees) -> None:
+        '''Функция для сброса кешей работника только в своем воркере'''
+        drop_employees({'employees': [(employee.id, employee.login) for employee in employees]})
+
+    @classmethod
+    def drop_changed_employees(cls, rows: List[dict]) -> None:
+        '''Функция для сброса в своем воркере строк из notify_employee_changes (остальным ушел NOTIFY)'''
+        if len(rows) > EMPLOYEE_CACHE_NOTIFY_LIMIT:
+            drop_employees({'clear': True})
+        else:
+            drop_employees({'employees': [(row['id'], row['login']) for row in rows]})
+            drop_employees({'employees': [(row['id'], row['old_login']) for row in rows if 'old_login' in row]})
+
+
+    @classmethod
+    async def refresh_vacation_flags(cls, employee_ids: Optional[Sequence[int]] = None,
+                                     today: Optional[date] = None) -> int:
+        '''Функция для пересчета is_vacation одним UPDATE: по всем работникам или по переданным id'''
+        today = today or date.today()
+        client = connections.get('default')
+        if employee_ids is None:
+            changed = await client.execute_query_dict(
+                notify_employee_changes(EMPLOYEE_VACATION_FLAG_SQL.format(where='')), [today])
+        else:
+            employee_ids = [employee_id for employee_id in set(employee_ids) if employee_id is not None]
+            if not employee_ids:
+                return 0
+            changed = await client.execute_query_dict(notify_employee_changes(
+                EMPLOYEE_VACATION_FLAG_SQL.format(where='WHERE e2.id = ANY($2::int[])')), [today, employee_ids])
+        cls.drop_changed_employees(changed)
+        return len(changed)
+
+    @classmethod
+    def employee_search_query(
+        cls,
+        last_name: Optional[str] = None,
+        first_name: Optional[str] = None,
+        patronymic: Optional[str] = None,
+        email: Optional[str] = None,
+        login: Optional[str] = None,
+    ) -> QuerySet:
+        '''Функция для построения запроса поиска по индексам lower(...)'''
+        query = Employees.all()
+        for field, value in (
+            ('last_name', last_name),
+            ('first_name', first_name),
+            ('patronymic', patronymic),
+            ('email', email),
+            ('login', login),
+        ):
+            if value:
+                query = query.annotate(**{f'{field}_lower': Lower(field)}).filter(
+                    **{f'{field}_lower': value.lower()})
+        return query
 
     @classmethod
     async def get_employee(
@@ -29,77 +292,246 @@ class Repository(BaseModel):
         login: Optional[str] = None,
     ) -> List[Employees]:
         '''Функция для получения работника'''
-        query = Employees.all()
+        return await cls.employee_search_query(
+            last_name=last_name,
+            first_name=first_name,
+            patronymic=patronymic,
+            email=email,
+            login=login,
+        ).using_db(read_connection())
+
+    @classmethod
+    async def search_employees_fuzzy(cls, q: str, limit: int, threshold: Optional[float] = None) -> List[dict]:
+        '''Функция для нечеткого поиска работников по триграммам с ранжированием'''
+        threshold = settings.search_similarity_threshold if threshold is None else threshold
+        async with in_transaction(read_connection_name()) as connection:
+            await connection.execute_query(
+                "SELECT set_config('pg_trgm.word_similarity_threshold', $1, true)",
+                [str(threshold)],
+            )
+            return await connection.execute_query_dict(EMPLOYEE_FUZZY_SEARCH_SQL, [q, limit])
 
-        if last_name:
-            query = query.filter(last_name__iexact=last_name)
-        if first_name:
-            query = query.filter(first_name__iexact=first_name)
-        if patronymic:
-            query = query.filter(patronymic__iexact=patronymic)
-        if email:
-            query = query.filter(email__iexact=email)
-        if login:
-            query = query.filter(login__iexact=login)
-        return await query
+    @classmethod
+    async def get_employee_by_login(cls, login: str) -> Optional[Employees]:
+        '''Функция для получения работника по логину без учета регистра через кеш'''
+        employee = employees_by_login.get(login.lower())
+        if employee is None:
+            employee = await cls.employee_search_query(login=login).first()
+            if employee is not None:
+                cls._cache_employee(employee)
+        return employee
 
     @classmethod
     async def add_employee(cls,employee: EmployeeAdd) -> Employees:
         '''Функция для добавления работника'''
-        employee = await Employees.create(**employee.model_dump())
+        # is_vacation выводится из отпусков, а у нового работника их нет
+        employee = await Employees.create(**employee.model_dump(), is_vacation='no')
         return employee
 
+    @classmethod
+    async def bulk_add_employees(
+        cls,
+        rows: Sequence[dict],
+        chunk_size: int = EMPLOYEE_BULK_CHUNK_SIZE,
+    ) -> List[dict]:
+        '''Функция для пакетного добавления работников с отчетом по каждой строке'''
+        results = []
+        seen_emails = set()
+        seen_logins = set()
+        for start in range(0, len(rows), chunk_size):
+            chunk_results, valid = [], []
+            for index, row in enumerate(rows[start:start + chunk_size], start=start):
+                try:
+                    employee = EmployeeAdd.model_validate(row)
+                except ValidationError as error:
+                    chunk_results.append({'row': index, 'error': error.errors()[0]['msg']})
+                    continue
+                if employee.password is None:
+                    # Без пароля строка упадет на NOT NULL и утянет весь INSERT пачки
+                    chunk_results.append({'row': index, 'error': 'password is required'})
+                    continue
+                chunk_results.append({'row': index})
+                valid.append((chunk_results[-1], employee.model_dump(mode='json')))
+
+            emails = {data['email'] for _, data in valid if data['email']}
+            logins = {data['login'] for _, data in valid if data['login']}
+            if emails or logins:
+                existing = await Employees.filter(
+                    Q(email__in=list(emails)) | Q(login__in=list(logins))
+                ).values_list('email', 'login')
+                seen_emails.update(email for email, _ in existing if email)
+                seen_logins.update(login for _, login in existing if login)
+
+            to_insert = []
+            for result, data in valid:
+                if data['email'] and data['email'] in seen_emails:
+                    result['error'] = 'duplicate email'
+                elif data['login'] and data['login'] in seen_logins:
+                    result['error'] = 'duplicate login'
+                else:
+                    seen_emails.add(data['email'])
+                    seen_logins.add(data['login'])
+                    to_insert.append((result, data))
+
+            if to_insert:
+                await cls._insert_employee_chunk(to_insert)
+            results.extend(chunk_results)
+        return results
+
+    @staticmethod
+    def _employee_integrity_error(error: IntegrityError) -> str:
+        '''Функция для текста ошибки строки по нарушенному ограничению (SQLSTATE из asyncpg)'''
+        cause = error.args[0] if error.args else None
+        sqlstate = getattr(cause, 'sqlstate', None)
+        if sqlstate == '23505':
+            return 'duplicate email' if 'email' in (cause.constraint_name or '') else 'duplicate login'
+        if sqlstate == '23502':
+            return f'{cause.column_name} is required'
+        return str(error)
+
+    @classmethod
+    async def _insert_employee_chunk(cls, chunk: List[tuple]) -> None:
+        '''Функция для вставки пачки работников одним INSERT в транзакции'''
+        columns = [[data[column] for _, data in chunk] for column in EMPLOYEE_BULK_COLUMNS]
+        try:
+            async with in_transaction() as connection:
+                _, inserted = await connection.execute_query(EMPLOYEE_BULK_INSERT_SQL, columns)
+        except IntegrityError:
+            # Конкурентная вставка заняла логин: откатываемся к построчной вставке тем же INSERT,
+            # чтобы причина ошибки каждой строки пришла из БД
+            client = connections.get('default')
+            for result, data in chunk:
+                try:
+                    _, inserted = await client.execute_query(
+                        EMPLOYEE_BULK_INSERT_SQL, [[data[column]] for column in EMPLOYEE_BULK_COLUMNS])
+                    result['id'] = inserted[0]['id']
+                except IntegrityError as error:
+                    result['error'] = cls._employee_integrity_error(error)
+            return
+        for (result, _), record in zip(chunk, inserted):
+            result['id'] = record['id']
+
     @classmethod
     async def update_employee(cls, id: int, employee: EmployeeUpdate) -> Optional[Employees]:
         '''Функция для обновления работника'''
-        emp = await Employees.get_or_none(id=id)
-        if emp:
-            await emp.update_from_dict(employee.model_dump(exclude_none=True))
-            await emp.save()
-            return emp
-        return emp
+        data = employee.model_dump(mode='json', exclude_none=True, exclude={'id'})
+        columns = ', '.join(f'"{column}" = ${index}' for index, column in enumerate(data, start=2)) or '"id" = "id"'
+        client = connections.get('default')
+        rows = await client.execute_query_dict(notify_employee_changes(
+            f'UPDATE "employees" e SET {columns} FROM (SELECT "login" AS old_login FROM "employees" '
+            'WHERE "id" = $1) AS old WHERE e."id" = $1 RETURNING e.*, old.old_login',
+            keys='SELECT id, login FROM changed UNION ALL SELECT id, old_login FROM changed',
+        ), [id, *data.values()])
+        if not rows:
+            return None
+        cls.drop_changed_employees(rows)
+        rows[0].pop('old_login')
+        return rows[0]
 
     @classmethod
     async def delete_employee(cls,id: int) -> bool:
         '''Функция для удаления работника'''
-        emp = await Employees.get_or_none(id=id)
-        if emp:
-            await emp.delete()
-            return emp
-        return emp
-
-    @classmethod
-    async def get_all_subdivisions(cls):
-        '''Функция для получения всех подразделений'''
-        subdivisions = await Subdivisions.all().prefetch_related('employees', 'leader')
-        result = []
-        for subdivision in subdivisions:
-            employee_ids = [employee.id for employee in subdivision.employees]
-            result.append({
-                'id': subdivision.id,
-                'name': subdivision.name,
-                'leader_id': subdivision.leader.id if subdivision.leader else None,
-                'employee_ids': employee_ids,
-            })
-        return result
-
-    @classmethod
-    async def get_subdivision_by_id(cls, subdivision_id: int) -> Optional[Subdivisions]:
+        client = connections.get('default')
+        rows = await client.execute_query_dict(notify_employee_changes(
+            'DELETE FROM "employees" WHERE "id" = $1 RETURNING "id", "login"'), [id])
+        if not rows:
+            return False
+        cls.drop_changed_employees(rows)
+        await cls._publish_org_chart({'op': 'drop_employee', 'employee_id': id})
+        return True
+
+    @classmethod
+    async def get_all_subdivisions(
+        cls,
+        after: Optional[int] = None,
+        limit: Optional[int] = None,
+        counts_only: bool = False,
+    ) -> List[dict]:
+        '''Функция для получения страницы подразделений из снимка или из БД'''
+        if org_chart.loaded:
+            return org_chart.page(after=after, limit=limit, counts_only=counts_only)
+        return await cls.fetch_subdivisions(after=after, limit=limit, counts_only=counts_only,
+                                            using_db=read_connection())
+
+    @classmethod
+    async def fetch_subdivisions(
+        cls,
+        after: Optional[int] = None,
+        limit: Optional[int] = None,
+        counts_only: bool = False,
+        using_db: Optional[BaseDBAsyncClient] = None,
+    ) -> List[dict]:
+        '''Функция для получения страницы подразделений с составом одним агрегирующим запросом'''
+        sql = SUBDIVISION_MEMBERS_SQL.format(
+            members=SUBDIVISION_MEMBERS_AGG['employee_count' if counts_only else 'employee_ids'],
+            subdivisions=SUBDIVISION_PAGE_SQL,
+        )
+        client = using_db or connections.get('default')
+        return await client.execute_query_dict(sql, [after, limit])
+
+    @classmethod
+    async def get_subdivision_by_id(cls, subdivision_id: int,
+                                    using_db: Optional[BaseDBAsyncClient] = None) -> Optional[dict]:
         '''Функция для получения подразделения по айди'''
-        subdivision = await Subdivisions.filter(id=subdivision_id).prefetch_related('employees').first()
-        if subdivision:
-            subdivision.employee_ids = [employee.id for employee in subdivision.employees]
-        return subdivision
+        if org_chart.loaded:
+            return org_chart.get(subdivision_id)
+        sql = SUBDIVISION_MEMBERS_SQL.format(
+            members=SUBDIVISION_MEMBERS_AGG['employee_ids'],
+            subdivisions='SELECT id, name, leader_id FROM "subdivisions" WHERE id = $1',
+        )
+        client = using_db or read_connection()
+        rows = await client.execute_query_dict(sql, [subdivision_id])
+        return rows[0] if rows else None
+
+    @classmethod
+    async def load_org_chart(cls, dsn: str) -> None:
+        '''Функция для подписки на патчи, сбросы кеша и отзывы токенов и построения снимка подразделений'''
+        await org_chart.listen(dsn, reload=lambda: cls.load_org_chart(dsn),
+                               subscriptions={EMPLOYEE_CACHE_CHANNEL: drop_employees,
+                                              REVOKED_TOKENS_CHANNEL: add_revoked_tokens})
+        # Сообщения, пришедшие, пока подписки не было, потеряны: кеш сбрасывается, отзывы читаются из БД
+        drop_employees({'clear': True})
+        client = connections.get('default')
+        revoked = await client.execute_query_dict(REVOKED_TOKENS_SQL)
+        add_revoked_tokens({'tokens': [(row['jti'], row['exp']) for row in revoked]})
+        org_chart.replace(await cls.fetch_subdivisions())
+
+    @classmethod
+    async def revoke_token(cls, jti: str, exp: float) -> None:
+        '''Функция для отзыва токена во всех воркерах до истечения его срока'''
+        client = connections.get('default')
+        await client.execute_query(REVOKE_TOKEN_SQL, [jti, exp])
+        add_revoked_tokens({'tokens': [(jti, exp)]})
+
+    @classmethod
+    async def check_org_chart(cls, repair: bool = False) -> dict:
+        '''Функция для сверки снимка подразделений с БД, repair пересобирает снимок'''
+        rows = await cls.fetch_subdivisions()
+        report = org_chart.diff(rows)
+        if repair and not report['consistent']:
+            org_chart.replace(rows)
+        return report
+
+    @classmethod
+    async def _publish_org_chart(cls, message: dict) -> None:
+        '''Функция для патча снимка и рассылки патча остальным воркерам'''
+        # Рассылка не зависит от своего снимка: пока он пересобирается, остальным патч нужен
+        if org_chart.loaded:
+            org_chart.apply(message)
+        client = connections.get('default')
+        await client.execute_query('SELECT pg_notify($1, $2)', [ORG_CHART_CHANNEL, json.dumps(message)])
 
     @classmethod
     async def add_subdivision(cls, name: str, leader_id: Optional[int] = None) -> Optional[Subdivisions]:
         '''Функция для добавления подразделения'''
-        try:
-            leader = await Employees.get(id=leader_id) if leader_id else None
-        except DoesNotExist:
+        # Проверка перед записью идет мимо кеша: удаленный работник дал бы 422 по FK вместо 404
+        leader = await Employees.get_or_none(id=leader_id) if leader_id else None
+        if leader_id and leader is None:
             return None
 
         new_subdivision = await Subdivisions.create(name=name, leader=leader)
+        await cls._publish_org_chart({'op': 'put', 'id': new_subdivision.id,
+                                      'name': new_subdivision.name, 'leader_id': leader_id})
         return new_subdivision
 
     @classmethod
@@ -110,19 +542,20 @@ class Repository(BaseModel):
             return None
         sub.name = name.lower()
         await sub.save()
+        await cls._publish_org_chart({'op': 'rename', 'id': sub.id, 'name': sub.name})
         return sub
 
     @classmethod
     async def assign_leader(cls, subdivision_id: int, leader_id: int) -> Optional[Subdivisions]:
         '''Функция для добавления руководителя к подразделению'''
-        try:
-            subdivision = await Subdivisions.get(id=subdivision_id)
-            leader = await Employees.get(id=leader_id)
-        except DoesNotExist:
+        subdivision = await Subdivisions.get_or_none(id=subdivision_id)
+        leader = await Employees.get_or_none(id=leader_id)
+        if subdivision is None or leader is None:
             return None
 
         subdivision.leader = leader
         await subdivision.save()
+        await cls._publish_org_chart({'op': 'set_leader', 'id': subdivision.id, 'leader_id': leader.id})
         return subdivision
 
     @classmethod
@@ -136,6 +569,7 @@ class Repository(BaseModel):
         if not employee:
             return None
         await subdivision.employees.add(employee)
+        await cls._publish_org_chart({'op': 'add_member', 'id': subdivision.id, 'employee_id': employee.id})
         return subdivision
 
     @classmethod
@@ -148,14 +582,8 @@ class Repository(BaseModel):
         if not employee:
             return None
         await subdivision.employees.remove(employee)
-        await subdivision.fetch_related('employees')
-        subdivision_data = Subdivision(
-            id=subdivision.id,
-            name=subdivision.name,
-            leader_id=subdivision.leader_id,
-            employee_ids=[employee.id for employee in subdivision.employees]
-        )
-        return subdivision_data
+        await cls._publish_org_chart({'op': 'remove_member', 'id': subdivision.id, 'employee_id': employee.id})
+        return Subdivision(**await cls.get_subdivision_by_id(subdivision.id, using_db=connections.get('default')))
 
     @classmethod
     async def delete_subdivision(cls, id: int) -> bool:
@@ -163,77 +591,197 @@ class Repository(BaseModel):
         sub = await Subdivisions.get_or_none(id=id)
         if sub:
             await sub.delete()
+            await cls._publish_org_chart({'op': 'drop', 'id': sub.id})
             return sub
         return sub
 
     @classmethod
-    async def get_all_vacations(cls):
-        '''Функция для получения всех отпусков и командировок'''
-        return await Vacations.all()
+    async def get_all_vacations(cls) -> List[dict]:
+        '''Функция для получения всех отпусков и командировок через values()'''
+        return await Vacations.all().using_db(read_connection()).order_by('id').values(*VACATION_EXPORT_COLUMNS)
+
+    @classmethod
+    async def iter_vacations(
+        cls,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        type: Optional[str] = None,
+        batch_size: int = VACATION_EXPORT_BATCH_SIZE,
+    ) -> AsyncIterator[list]:
+        '''Функция для чтения отпусков и командировок пачками через серверный курсор'''
+        conditions = []
+        args = []
+        if date_from:
+            args.append(date_from)
+            conditions.append(f'"end_date" >= ${len(args)}')
+        if date_to:
+            args.append(date_to)
+            conditions.append(f'"start_date" <= ${len(args)}')
+        if type:
+            args.append(type)
+            conditions.append(f'"type" = ${len(args)}')
+        sql = f'SELECT {", ".join(VACATION_EXPORT_COLUMNS)} FROM "vacations"'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY "id"'
+
+        client = read_connection()
+        db_seconds = 0.0
+        try:
+            async with client.acquire_connection() as connection:
+                async with connection.transaction():
+                    started = time.perf_counter()
+                    cursor = await connection.cursor(sql, *args)
+                    while True:
+                        rows = await cursor.fetch(batch_size)
+                        db_seconds += time.perf_counter() - started
+                        if not rows:
+                            break
+                        yield rows
+                        started = time.perf_counter()
+        finally:
+            # Курсор идет мимо клиента Tortoise; учитывается как один запрос
+            record_query(sql, db_seconds)
 
     @classmethod
     async def get_employee_with_vacations(cls, employee_id: Optional[int] = None,
-                                          type: Optional[str] = None):
-        '''Функция для получения работника с отпусками или командировками'''
-        filters = {}
-        if employee_id:
-            filters["id"] = employee_id
-        employees = await Employees.filter(**filters).prefetch_related('vacations')
-        result = []
-        for employee in employees:
-            vacations = employee.vacations
-            if type:
-                vacations = [vacation for vacation in vacations if vacation.type == type]
-            result.append({
-                "id": employee.id,
-                "last_name": employee.last_name,
-                "first_name": employee.first_name,
-                "patronymic": employee.patronymic,
-                "email": employee.email,
-                "login": employee.login,
-                "password": employee.password,
-                "vacations": [
-                    {
-                        "id": vacation.id,
-                        "employee_id": employee.id,
-                        "start_date": vacation.start_date,
-                        "end_date": vacation.end_date,
-                        "type": vacation.type
-                    }
-                    for vacation in vacations
-                ]
-            })
-        return result
+                                          type: Optional[str] = None,
+                                          date_from: Optional[date] = None,
+                                          date_to: Optional[date] = None,
+                                          after: Optional[int] = None,
+                                          limit: Optional[int] = None) -> List[dict]:
+        '''Функция для получения работников с отпусками или командировками (keyset по id).
+
+        Тип и период фильтруются в SQL, работники без подходящих записей пропускаются.
+        '''
+        client = read_connection()
+        rows = await client.execute_query_dict(
+            EMPLOYEE_VACATIONS_SEARCH_SQL,
+            [employee_id, getattr(type, 'value', type), date_from, date_to, after, limit],
+        )
+        for row in rows:
+            row["vacations"] = json.loads(row["vacations"])
+        return rows
+
+    @classmethod
+    async def get_subdivision_absences(cls, employee_ids: Sequence[int],
+                                       date_from: date, date_to: date) -> dict:
+        '''Функция для получения отпусков и командировок работников, пересекающих период, одним запросом.
+
+        Результат по столбцам (массивы одной строки): employee_ids, business, а также starts/ends -
+        номера дней от date_from, обрезанные по периоду. Так десятки тысяч строк не превращаются в dict.
+        '''
+        client = read_connection()
+        rows = await client.execute_query_dict(SUBDIVISION_ABSENCES_SQL, [list(employee_ids), date_from, date_to])
+        return {key: value or [] for key, value in rows[0].items()}
 
     @classmethod
     async def add_vacation(cls, vacation: VacationAdd) -> Optional[Vacations]:
-        '''Функция для добавления отпуска или командировки'''
-        overlaps = await Vacations.filter(
-            employee_id=vacation.employee_id,
-            start_date__lte=vacation.end_date,
-            end_date__gte=vacation.start_date
-        ).exists()
-        if overlaps:
-            return None
-        new_vacation = await Vacations.create(**vacation.model_dump())
+        '''Функция для добавления отпуска или командировки
+
+        Пересечение проверяет ограничение vacations_no_overlap в том же INSERT.
+        '''
+        try:
+            new_vacation = await Vacations.create(**vacation.model_dump())
+        except IntegrityError as error:
+            if VACATION_OVERLAP_CONSTRAINT in str(error):
+                return None
+            raise
+        if vacation_covers(new_vacation.start_date, new_vacation.end_date, date.today()):
+            await cls.refresh_vacation_flags([new_vacation.employee_id])
         return new_vacation
 
     @classmethod
-    async def update_vacation(cls, id: int, vacation: VacationUpdate) -> Optional[Vacations]:
-        '''Функция для обновления отпуска или командировки'''
-        overlap = await Vacations.filter(
-            start_date__lt=vacation.end_date,
-            end_date__gt=vacation.start_date
-        ).exclude(id=id).exists()
-        if overlap:
-            return None
+    async def bulk_add_vacations(
+        cls,
+        rows: Sequence[dict],
+        chunk_size: int = VACATION_BULK_CHUNK_SIZE,
+    ) -> dict:
+        '''Функция для пакетного добавления отпусков и командировок без пересечений'''
+        conflicts = []
+        valid = []
+        for index, row in enumerate(rows):
+            try:
+                vacation = VacationAdd.model_validate(row)
+            except ValidationError as error:
+                conflicts.append({'row': index, 'error': error.errors()[0]['msg']})
+                continue
+            if vacation.start_date is None or vacation.end_date is None:
+                conflicts.append({'row': index, 'error': 'start_date and end_date are required'})
+            else:
+                valid.append((index, vacation))
+
+        overlaps = find_vacation_overlaps(valid)
+        conflicts.extend({'row': row, 'error': f'overlaps row {other}'} for row, other in overlaps.items())
+        valid = [item for item in valid if item[0] not in overlaps]
+
+        created = 0
+        for start in range(0, len(valid), chunk_size):
+            chunk = valid[start:start + chunk_size]
+            async with in_transaction() as connection:
+                _, rejected = await connection.execute_query(VACATION_BULK_CHECK_SQL, [
+                    [vacation.employee_id for _, vacation in chunk],
+                    [vacation.start_date for _, vacation in chunk],
+                    [vacation.end_date for _, vacation in chunk],
+                    [row for row, _ in chunk],
+                ])
+                conflicts.extend({
+                    'row': record['ord'],
+                    'error': 'unknown employee_id' if record['unknown'] else 'overlaps existing vacation',
+                } for record in rejected)
+                rejected_rows = {record['ord'] for record in rejected}
+                chunk = [item for item in chunk if item[0] not in rejected_rows]
+                if chunk:
+                    _, inserted = await connection.execute_query(VACATION_BULK_INSERT_SQL, [
+                        [vacation.employee_id for _, vacation in chunk],
+                        [vacation.start_date for _, vacation in chunk],
+                        [vacation.end_date for _, vacation in chunk],
+                        [vacation.type.value for _, vacation in chunk],
+                    ])
+                    # ON CONFLICT DO NOTHING молча пропускает строки, вставленные конкурентно между
+                    # проверкой и INSERT; в пачке нет пересечений, поэтому (работник, начало) уникальны
+                    stored = {(record['employee_id'], record['start_date']) for record in inserted}
+                    conflicts.extend({'row': row, 'error': 'overlaps existing vacation'} for row, vacation in chunk
+                                     if (vacation.employee_id, vacation.start_date) not in stored)
+                    created += len(stored)
+                    today = date.today()
+                    await cls.refresh_vacation_flags(
+                        [vacation.employee_id for _, vacation in chunk
+                         if vacation.start_date <= today <= vacation.end_date])
+        conflicts.sort(key=lambda conflict: conflict['row'])
+        return {'created': created, 'conflicts': conflicts}
+
+    @classmethod
+    async def update_vacation(cls, id: int, vacation: VacationUpdate) -> Optional[dict]:
+        '''Функция для обновления отпуска или командировки одним UPDATE
+
+        Пересечение с отпусками того же работника проверяет ограничение vacations_no_overlap.
+        '''
+        data = vacation.model_dump(exclude_none=True, exclude={'id'})
+        data['type'] = vacation.type.value
+        columns = ', '.join(f'"{column}" = ${index}' for index, column in enumerate(data, start=2))
+        client = connections.get('default')
         try:
-            vac = await Vacations.get_or_none(id=id)
-        except DoesNotExist:
+            rows = await client.execute_query_dict(
+                'WITH old AS (SELECT "employee_id", "start_date", "end_date" FROM "vacations" WHERE "id" = $1) '
+                f'UPDATE "vacations" SET {columns} WHERE "id" = $1 {VACATION_RETURNING}, '
+                '(SELECT "employee_id" FROM old) AS old_employee_id, '
+                '(SELECT "start_date" FROM old) AS old_start_date, (SELECT "end_date" FROM old) AS old_end_date',
+                [id, *data.values()],
+            )
+        except IntegrityError as error:
+            if VACATION_OVERLAP_CONSTRAINT in str(error):
+                return None
+            raise
+        if not rows:
             return None
-        await vac.update_from_dict(vacation.model_dump(exclude_none=True))
-        await vac.save()
-        return vac
+        updated = rows[0]
+        old_employee_id = updated.pop('old_employee_id')
+        today = date.today()
+        if (vacation_covers(updated.pop('old_start_date'), updated.pop('old_end_date'), today)
+                or vacation_covers(updated['start_date'], updated['end_date'], today)):
+            await cls.refresh_vacation_flags([old_employee_id, updated['employee_id']])
+        return updated
 
     @classmethod
     async def delete_vacation(cls,id: int) -> bool:
@@ -241,5 +789,7 @@ class Repository(BaseModel):
         vacation = await Vacations.get_or_none(id=id)
         if vacation:
             await vacation.delete()
+            if vacation_covers(vacation.start_date, vacation.end_date, date.today()):
+                await cls.refresh_vacation_flags([vacation.employee_id])
             return vacation
         return vacation
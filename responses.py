@@ -0,0 +1,38 @@
+'''responses.py'''
+
+from typing import Any, Iterator, Optional, Sequence
+import orjson
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+from settings import settings
+
+def _orjson_array_chunks(rows: Sequence[dict], chunk_size: int) -> Iterator[bytes]:
+    '''Функция для кодирования JSON-массива частями по chunk_size строк'''
+    yield b"["
+    for start in range(0, len(rows), chunk_size):
+        chunk = orjson.dumps(rows[start:start + chunk_size])[1:-1]
+        yield chunk if start == 0 else b"," + chunk
+    yield b"]"
+
+def orjson_list_response(rows: Sequence[dict], response: Optional[Response] = None,
+                         chunk_size: Optional[int] = None) -> Response:
+    '''Функция для быстрой отдачи списка строк из .values() без валидации Pydantic.
+
+    Подходит только для доверенных данных из БД (уже прошедших схемы при записи);
+    большие списки отдаются потоком частями. Заголовки переносятся из response эндпоинта.
+    '''
+    headers = {}
+    if response is not None:
+        headers = {key: value for key, value in response.headers.items() if key != "content-length"}
+    chunk_size = chunk_size or settings.list_response_chunk_size
+    if len(rows) <= chunk_size:
+        return Response(orjson.dumps(rows), media_type="application/json", headers=headers)
+    return StreamingResponse(_orjson_array_chunks(rows, chunk_size),
+                             media_type="application/json", headers=headers)
+
+def orjson_response(content: Any, response: Optional[Response] = None) -> Response:
+    '''Функция для отдачи доверенного ответа из БД через orjson без валидации response_model'''
+    headers = {}
+    if response is not None:
+        headers = {key: value for key, value in response.headers.items() if key != "content-length"}
+    return Response(orjson.dumps(content), media_type="application/json", headers=headers)
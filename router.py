@@ -1,63 +1,86 @@
 '''router.py'''
 
 from typing import Annotated, List, Optional
-from datetime import datetime, timedelta
-from fastapi import APIRouter, Depends, HTTPException, Path, Query
+from datetime import date, timedelta
+import csv
+import io
+import json
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, Path, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from passlib.context import CryptContext
-import jwt
-from psycopg2 import IntegrityError
+from tortoise import connections
+from tortoise.exceptions import IntegrityError
 from models import Employees
 from schemas import Employee, EmployeeAdd, EmployeeUpdate, EmployeeWithVacations
 from schemas import SubdivisionAdd, SubdivisionLeaderUpdate
-from schemas import Vacation, VacationAdd, VacationUpdate, VacationType
-from schemas import Subdivision, SubdivisionUpdate, SubdivisionEmployeeAdd
-from repository import Repository
+from schemas import Vacation, VacationAdd, VacationUpdate, VacationType, VacationBulkResult
+from schemas import SubdivisionAvailability
+from schemas import Subdivision, SubdivisionUpdate, SubdivisionEmployeeAdd, SubdivisionSummary
+from schemas import EMPLOYEE_LIST_FIELDS, EmployeeBulkResult, EmployeeListItem
+from repository import Repository, VACATION_EXPORT_COLUMNS
+from hashing import PasswordHasherBusy, password_hasher
+from availability import daily_counts_from_offsets
+from auth import create_access_token, get_current_employee, get_token_claims, revoke_token
+from auth import verified_tokens
+from responses import orjson_list_response, orjson_response
+from cache import employees_by_id, employees_by_login
+from db import PRIMARY, pool_metrics
+from metrics import CONTENT_TYPE, collect, render
 
 employee_router = APIRouter(prefix="/employee",
                             tags=["Employee Manager"])
 
-SECRET_KEY = "kains"
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 600
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+EMPLOYEES_PAGE_SIZE = 100
+EMPLOYEES_MAX_PAGE_SIZE = 1000
+EMPLOYEES_SEARCH_LIMIT = 20
 
-def verify_password(plain_password, hashed_password):
-    '''Функция для верификации пароля'''
-    return pwd_context.verify(plain_password, hashed_password)
+async def collection_etag(collection: str, request: Request, response: Response) -> Optional[Response]:
+    '''Функция для выставления ETag по версии коллекции; возвращает 304, если If-None-Match совпал'''
+    etag = f'"{collection}-{await Repository.get_collection_version(collection)}"'
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return None
 
-def get_password_hash(password):
-    '''Функция для получения хешированного пароля'''
-    return pwd_context.hash(password)
+async def verify_password(plain_password, hashed_password):
+    '''Функция для верификации пароля вне event loop'''
+    try:
+        return await password_hasher.verify(plain_password, hashed_password)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Сервис перегружен, повторите позже")
 
-def create_access_token(data: dict, expires_delta: timedelta | None = None):
-    '''Функция для создания доступа токена'''
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.now() + expires_delta
-    else:
-        expire = datetime.now() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+async def get_password_hash(password):
+    '''Функция для получения хешированного пароля вне event loop'''
+    try:
+        return await password_hasher.hash(password)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Сервис перегружен, повторите позже")
 
 @employee_router.get("/users/me")
-async def get_current_user(login: str):
-    '''Получение текущего пользователя по логину'''
-    user = await Employees.get_or_none(login=login)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def get_current_user(user: Employees = Depends(get_current_employee)):
+    '''Получение текущего пользователя по bearer-токену'''
     return user
 
+@employee_router.post("/logout")
+async def logout(claims: dict = Depends(get_token_claims)):
+    '''Отзыв текущего токена'''
+    await revoke_token(claims)
+    return {"detail": "Token revoked"}
+
 @employee_router.post("/register")
 async def register(user: Annotated[EmployeeAdd , Depends()]):
     '''Регистрация пользователя'''
-    hashed_password = pwd_context.hash(user.password)
+    hashed_password = await get_password_hash(user.password)
     user_data = user.model_dump()
     user_data['password'] = hashed_password
+    user_data['is_vacation'] = 'no'
 
     try:
         new_employee = await Employees.create(**user_data)
+        Repository.invalidate_employee(new_employee)
         access_token = create_access_token(data={"sub": new_employee.login})
         return {"access_token": access_token, "token_type": "bearer"}
     except IntegrityError:
@@ -66,34 +89,64 @@ async def register(user: Annotated[EmployeeAdd , Depends()]):
 @employee_router.post("/token")
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     '''Логин пользователя и получение токена'''
-    user = await Employees.get_or_none(login=form_data.username)
-    if not user or not pwd_context.verify(form_data.password, user.password):
+    user = await Repository.get_employee_by_login(form_data.username)
+    if not user or not await verify_password(form_data.password, user.password):
         raise HTTPException(status_code=400, detail="Неправильный логин или пароль")
     access_token = create_access_token(data={"sub": user.login})
     return {"access_token": access_token, "token_type": "bearer"}
 
-@employee_router.get("/get_all", response_model=List[Employee])
-async def read_all_employees():
-    '''Функция для получения всех работников'''
-    return await Repository.get_all_employees()
-
-@employee_router.get("/{user_id}", response_model=Employee)
-async def get_employee(user_id: int):
-    '''Функция для получения работника по ID'''
-    employee = await Repository.get_employee_by_id(user_id=user_id)
-    if not employee:
-        raise HTTPException(status_code=404, detail="User not found")
-    return employee
+@employee_router.get("/get_all", response_model=List[EmployeeListItem], response_model_exclude_unset=True)
+async def read_all_employees(
+    request: Request,
+    response: Response,
+    after: Optional[int] = Query(default=None, description="ID последнего работника предыдущей страницы"),
+    limit: int = Query(default=EMPLOYEES_PAGE_SIZE, ge=1, le=EMPLOYEES_MAX_PAGE_SIZE),
+    fields: Optional[str] = Query(default=None, description="Список полей через запятую: id,login,email"),
+    unbounded: bool = Query(default=False, description="Вернуть все строки после курсора без limit"),
+):
+    '''Функция для получения работников постранично'''
+    not_modified = await collection_etag("employees", request, response)
+    if not_modified:
+        return not_modified
+    selected = None
+    if fields:
+        selected = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = set(selected) - set(EMPLOYEE_LIST_FIELDS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+        if "id" not in selected:
+            selected.insert(0, "id")
+    employees = await Repository.get_all_employees(
+        after=after,
+        limit=None if unbounded else limit,
+        fields=selected,
+    )
+    if not unbounded and len(employees) == limit:
+        response.headers["X-Next-After"] = str(employees[-1]["id"])
+    if request.app.state.settings.list_response_fast_path:
+        return orjson_list_response(employees, response,
+                                    chunk_size=request.app.state.settings.list_response_chunk_size)
+    return employees
 
 @employee_router.get("/search", response_model=List[Employee])
 async def read_employee(
+    request: Request,
     last_name: Optional[str] = Query(default=None),
     first_name: Optional[str] = Query(default=None),
     patronymic: Optional[str] = Query(default=None),
     email: Optional[str] = Query(default=None),
     login: Optional[str] = Query(default=None),
+    q: Optional[str] = Query(default=None, min_length=2,
+                             description="Нечеткий поиск по ФИО, логину и email"),
+    limit: int = Query(default=EMPLOYEES_SEARCH_LIMIT, ge=1, le=EMPLOYEES_MAX_PAGE_SIZE),
 ):
-    '''Функция для получения одного работника'''
+    '''Функция для получения одного работника или нечеткого поиска по q'''
+    if q:
+        employees = await Repository.search_employees_fuzzy(
+            q, limit, threshold=request.app.state.settings.search_similarity_threshold)
+        if not employees:
+            raise HTTPException(status_code=404, detail="Employee not found")
+        return employees
     employee = await Repository.get_employee(
         last_name=last_name,
         first_name=first_name,
@@ -105,6 +158,14 @@ async def read_employee(
         raise HTTPException(status_code=404, detail="Employee not found")
     return employee
 
+@employee_router.get("/{user_id}", response_model=Employee)
+async def get_employee(user_id: int):
+    '''Функция для получения работника по ID'''
+    employee = await Repository.get_employee_by_id(user_id=user_id)
+    if not employee:
+        raise HTTPException(status_code=404, detail="User not found")
+    return employee
+
 @employee_router.post("/add", response_model=Employee)
 async def add_employee(employee: Annotated[EmployeeAdd, Depends()]):
     '''Функция для добавления работника'''
@@ -114,6 +175,22 @@ async def add_employee(employee: Annotated[EmployeeAdd, Depends()]):
         raise HTTPException(status_code=404, detail="Employee aleardy exist")
     return employee
 
+@employee_router.post("/bulk", response_model=List[EmployeeBulkResult], response_model_exclude_none=True)
+async def bulk_add_employees(request: Request):
+    '''Функция для пакетного добавления работников из JSON-массива или CSV с заголовком'''
+    body = await request.body()
+    if "text/csv" in request.headers.get("content-type", ""):
+        reader = csv.DictReader(io.StringIO(body.decode("utf-8-sig")))
+        rows = [{key: value or None for key, value in row.items()} for row in reader]
+    else:
+        try:
+            rows = json.loads(body)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body must be a JSON array or CSV")
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or CSV")
+    return await Repository.bulk_add_employees(rows)
+
 @employee_router.put("/update", response_model=EmployeeUpdate)
 async def update_employee(id: int,employee: Annotated[EmployeeUpdate, Depends()]):
     '''Функция для обновления работника'''
@@ -133,10 +210,31 @@ async def delete_employee(id:int):
 subdivision_router = APIRouter(prefix="/subdivision",
                                tags=["Subdivision Manager"])
 
-@subdivision_router.get("/get_all", response_model=List[Subdivision])
-async def read_all_subdivision():
-    '''Функция для получения всех подразделений'''
-    return await Repository.get_all_subdivisions()
+SUBDIVISIONS_PAGE_SIZE = 500
+SUBDIVISIONS_MAX_PAGE_SIZE = 5000
+
+@subdivision_router.get("/get_all", response_model=List[SubdivisionSummary],
+                        response_model_exclude_unset=True)
+async def read_all_subdivision(
+    request: Request,
+    response: Response,
+    after: Optional[int] = Query(default=None, description="ID последнего подразделения предыдущей страницы"),
+    limit: int = Query(default=SUBDIVISIONS_PAGE_SIZE, ge=1, le=SUBDIVISIONS_MAX_PAGE_SIZE),
+    counts_only: bool = Query(default=False, description="Вернуть число работников вместо их ID"),
+    unbounded: bool = Query(default=False, description="Вернуть все строки после курсора без limit"),
+):
+    '''Функция для получения подразделений постранично'''
+    not_modified = await collection_etag("subdivisions", request, response)
+    if not_modified:
+        return not_modified
+    subdivisions = await Repository.get_all_subdivisions(
+        after=after,
+        limit=None if unbounded else limit,
+        counts_only=counts_only,
+    )
+    if not unbounded and len(subdivisions) == limit:
+        response.headers["X-Next-After"] = str(subdivisions[-1]["id"])
+    return subdivisions
 
 @subdivision_router.get("/{subdivision_id}", response_model=Subdivision)
 async def read_subdivision(subdivision_id: int):
@@ -213,20 +311,107 @@ async def delete_subdivision(id: int):
 vacation_router = APIRouter(prefix="/business_and_vacations",
                             tags=["Business and Vacations Manager"])
 
+AVAILABILITY_MAX_DAYS = 731
+
 @vacation_router.get("/get_all", response_model=List[Vacation])
-async def read_company_vacations_and_business():
+async def read_company_vacations_and_business(request: Request, response: Response):
     '''Функция для получения всех отпусков и командировок работников'''
-    return await Repository.get_all_vacations()
+    not_modified = await collection_etag("vacations", request, response)
+    if not_modified:
+        return not_modified
+    vacations = await Repository.get_all_vacations()
+    if request.app.state.settings.list_response_fast_path:
+        return orjson_list_response(vacations, response,
+                                    chunk_size=request.app.state.settings.list_response_chunk_size)
+    return vacations
+
+async def _vacations_ndjson(batches):
+    '''Функция для построчной записи отпусков в NDJSON'''
+    async for rows in batches:
+        yield "".join(json.dumps(dict(row), default=str, ensure_ascii=False) + "\n" for row in rows)
+
+async def _vacations_csv(batches):
+    '''Функция для построчной записи отпусков в CSV'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(VACATION_EXPORT_COLUMNS)
+    async for rows in batches:
+        writer.writerows(tuple(row.values()) for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+@vacation_router.get("/export")
+async def export_vacations_and_business(
+    date_from: Optional[date] = Query(default=None, description="Начало периода"),
+    date_to: Optional[date] = Query(default=None, description="Конец периода"),
+    type: Optional[VacationType] = Query(default=None, description="Type of leave: 'vacation' or 'business'"),
+    accept: Optional[str] = Header(default=None),
+):
+    '''Функция для потоковой выгрузки отпусков и командировок в NDJSON или CSV'''
+    batches = Repository.iter_vacations(
+        date_from=date_from,
+        date_to=date_to,
+        type=type.value if type else None,
+    )
+    if accept and "text/csv" in accept:
+        return StreamingResponse(_vacations_csv(batches), media_type="text/csv",
+                                 headers={"Content-Disposition": "attachment; filename=vacations.csv"})
+    return StreamingResponse(_vacations_ndjson(batches), media_type="application/x-ndjson")
+
+@vacation_router.get("/availability", response_model=SubdivisionAvailability)
+async def read_subdivision_availability(
+    subdivision_id: int = Query(..., description="ID Subdivision"),
+    date_from: date = Query(..., description="Начало периода"),
+    date_to: date = Query(..., description="Конец периода"),
+):
+    '''Функция для получения отсутствующих в подразделении и их числа по дням'''
+    if date_to < date_from or (date_to - date_from).days >= AVAILABILITY_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Period must be 1..{AVAILABILITY_MAX_DAYS} days")
+    subdivision = await Repository.get_subdivision_by_id(subdivision_id)
+    if subdivision is None:
+        raise HTTPException(status_code=404, detail="Subdivision not found")
+    employee_ids = set(subdivision["employee_ids"])
+    if subdivision["leader_id"] is not None:
+        employee_ids.add(subdivision["leader_id"])
+    columns = await Repository.get_subdivision_absences(employee_ids, date_from, date_to)
+    days = [date_from + timedelta(days=offset) for offset in range((date_to - date_from).days + 1)]
+    absences = [
+        {"employee_id": employee_id, "type": "business" if business else "vacation",
+         "start_date": days[start], "end_date": days[end]}
+        for employee_id, business, start, end in zip(columns["employee_ids"], columns["business"],
+                                                     columns["starts"], columns["ends"])
+    ]
+    # Строки из БД уже соответствуют схеме Absence; десятки тысяч объектов не валидируются повторно
+    return orjson_response({
+        "subdivision_id": subdivision_id,
+        "date_from": date_from,
+        "date_to": date_to,
+        "absences": absences,
+        "daily": daily_counts_from_offsets(len(days), columns["starts"], columns["ends"], columns["business"]),
+    })
 
 @vacation_router.get("/search", response_model=List[EmployeeWithVacations])
 async def get_employees_with_vacations(
+    response: Response,
     employee_id: Optional[int] = Query(default=None),
-    type: VacationType = Query(..., description="Type of leave: 'vacation' or 'business'")
+    type: VacationType = Query(..., description="Type of leave: 'vacation' or 'business'"),
+    date_from: Optional[date] = Query(default=None, description="Начало периода, пересекающегося с записью"),
+    date_to: Optional[date] = Query(default=None, description="Конец периода, пересекающегося с записью"),
+    after: Optional[int] = Query(default=None, description="ID последнего работника предыдущей страницы"),
+    limit: int = Query(default=EMPLOYEES_PAGE_SIZE, ge=1, le=EMPLOYEES_MAX_PAGE_SIZE),
 ):
-    '''Функция для получения работника с отпусками или командировками'''
-    employees = await Repository.get_employee_with_vacations(employee_id=employee_id, type=type)
+    '''Функция для получения работников с отпусками или командировками постранично'''
+    if date_from and date_to and date_from > date_to:
+        raise HTTPException(status_code=400, detail="date_from must not be after date_to")
+    employees = await Repository.get_employee_with_vacations(
+        employee_id=employee_id, type=type, date_from=date_from, date_to=date_to,
+        after=after, limit=limit)
     if not employees:
         raise HTTPException(status_code=404, detail="No employees found")
+    if len(employees) == limit:
+        response.headers["X-Next-After"] = str(employees[-1]["id"])
     return employees
 
 @vacation_router.post("/add", response_model=Vacation)
@@ -240,6 +425,11 @@ async def add_vacations_or_business(
         raise HTTPException(status_code=404, detail="Date already in use,use another")
     return vacation
 
+@vacation_router.post("/bulk", response_model=VacationBulkResult)
+async def bulk_add_vacations_or_business(rows: List[dict] = Body(..., description="JSON-массив VacationAdd")):
+    '''Функция для пакетного добавления отпусков или командировок'''
+    return await Repository.bulk_add_vacations(rows)
+
 @vacation_router.put("/update", response_model=VacationUpdate)
 async def update_vacations_or_business(id: int,vacation: Annotated[VacationUpdate, Depends()]):
     '''Функция для обновления отпуска или командировки'''
@@ -255,3 +445,44 @@ async def delete_vacations_or_business(id: int):
     if not success:
         raise HTTPException(status_code=404, detail="Business And Vacation not found")
     return { "detail":"Busines And Vacation delete"}
+
+service_router = APIRouter(prefix="/service",
+                           tags=["Service"])
+
+@service_router.get("/password_hashing")
+async def read_password_hashing_metrics():
+    '''Функция для получения метрик пула хеширования паролей'''
+    return password_hasher.metrics()
+
+@service_router.get("/cache")
+async def read_cache_metrics():
+    '''Функция для получения счетчиков кешей'''
+    return {
+        "employees_by_id": employees_by_id.metrics(),
+        "employees_by_login": employees_by_login.metrics(),
+        "verified_tokens": verified_tokens.metrics(),
+    }
+
+@service_router.get("/startup")
+async def read_startup_report(request: Request):
+    '''Функция для получения времени импорта и шагов прогрева воркера'''
+    return getattr(request.app.state, "startup_report", {})
+
+@service_router.get("/db_pool")
+async def read_db_pool_metrics(connection: str = Query(default=PRIMARY, description="Соединение: default или replica")):
+    '''Функция для получения метрик пула соединений с БД'''
+    if connection not in connections.db_config:
+        raise HTTPException(status_code=404, detail=f"Connection {connection} is not configured")
+    return pool_metrics(connection)
+
+@service_router.post("/org_chart/check")
+async def check_org_chart(repair: bool = Query(default=False, description="Пересобрать снимок при расхождении")):
+    '''Функция для сверки снимка подразделений с БД'''
+    return await Repository.check_org_chart(repair=repair)
+
+metrics_router = APIRouter(tags=["Service"])
+
+@metrics_router.get("/metrics", response_class=Response)
+async def read_metrics(request: Request):
+    '''Функция для выдачи метрик по маршрутам в текстовом формате Prometheus'''
+    return Response(render(await collect(request.app.state.settings.metrics_dir)), media_type=CONTENT_TYPE)
@@ -0,0 +1,46 @@
+'''scheduler.py'''
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from metrics import write_snapshot
+from repository import Repository
+from settings import Settings, settings
+
+scheduler = AsyncIOScheduler()
+
+def start_scheduler(config: Settings = settings) -> None:
+    '''Функция для запуска периодических задач сервиса'''
+    # Пересчет is_vacation на границе суток; UPDATE трогает только изменившиеся строки,
+    # поэтому повторный запуск в каждом воркере безопасен
+    scheduler.add_job(
+        Repository.refresh_vacation_flags,
+        CronTrigger(hour=0, minute=0, second=5),
+        id="refresh_vacation_flags",
+        replace_existing=True,
+        misfire_grace_time=3600,
+        coalesce=True,
+    )
+    # Журнал изменений коллекций сворачивается, чтобы подсчет версии для ETag оставался дешевым
+    scheduler.add_job(
+        Repository.compact_collection_versions,
+        IntervalTrigger(seconds=60),
+        id="compact_collection_versions",
+        replace_existing=True,
+        coalesce=True,
+    )
+    if config.metrics_dir:
+        scheduler.add_job(
+            write_snapshot,
+            IntervalTrigger(seconds=config.metrics_flush_seconds),
+            args=(config.metrics_dir,),
+            id="write_metrics_snapshot",
+            replace_existing=True,
+            coalesce=True,
+        )
+    scheduler.start()
+
+def stop_scheduler() -> None:
+    '''Функция для остановки периодических задач'''
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
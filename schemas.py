@@ -2,9 +2,10 @@
 
 from datetime import date
 from enum import Enum
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic import BaseModel, Field
-from pydantic import EmailStr, field_validator
+from pydantic import EmailStr, field_validator, model_validator
+from pydantic_core import PydanticCustomError
 
 class YesNo(str, Enum):
     '''Класс схемы отпуска и командировки для уточнения'''
@@ -32,6 +33,20 @@ class Employee(BaseModel):
         '''Класс настройки'''
         from_attributes = True
 
+# Поля, которые можно запросить у /employee/get_all (хеш пароля не отдается)
+EMPLOYEE_LIST_FIELDS = tuple(name for name in Employee.model_fields if name != 'password')
+
+class EmployeeListItem(BaseModel):
+    '''Класс схемы работника в списке: только запрошенные поля, без пароля, значения как в БД'''
+    id: int
+    last_name: str | None = None
+    first_name: str | None = None
+    patronymic: str | None = None
+    email: EmailStr | None = None
+    login: str | None = None
+    is_supervisor: YesNo | None = None
+    is_vacation: YesNo | None = None
+
 class EmployeeAdd(BaseModel):
     '''Класс схемы работника для добавления'''
     last_name: str
@@ -40,14 +55,20 @@ class EmployeeAdd(BaseModel):
     email: EmailStr | None = None
     login:str | None = None
     password:str | None = None
-    is_supervisor: YesNo  = Field(description="Type of string: 'yes' or 'no'")
-    is_vacation: YesNo = Field(description="Type of string: 'yes' or 'no'")
+    is_supervisor: YesNo = Field(YesNo.NO, description="Type of string: 'yes' or 'no'")
+    # is_vacation не принимается: флаг выводится из отпусков (Repository.refresh_vacation_flags)
 
     @field_validator('last_name', 'first_name', 'patronymic', 'email', 'login')
     def to_lower(cls, v):
         '''Функция для смены регистра в нижний предел'''
         return v.lower() if isinstance(v, str) else v
 
+class EmployeeBulkResult(BaseModel):
+    '''Класс схемы результата пакетного добавления для одной строки'''
+    row: int
+    id: int | None = None
+    error: str | None = None
+
 class EmployeeUpdate(BaseModel):
     '''Класс схемы работника для обновления'''
     id : int
@@ -57,8 +78,7 @@ class EmployeeUpdate(BaseModel):
     email: EmailStr | None = None
     login:str | None = None
     password:str | None = None
-    is_supervisor: YesNo  = Field(description="Type of string: 'yes' or 'no'")
-    is_vacation: YesNo = Field(description="Type of string: 'yes' or 'no'")
+    is_supervisor: YesNo | None = Field(None, description="Type of string: 'yes' or 'no'")
 
     @field_validator('last_name', 'first_name', 'patronymic', 'email', 'login')
     def to_lower(cls, v):
@@ -118,6 +138,38 @@ class VacationAdd(BaseModel):
     start_date: date | None = None
     end_date: date | None = None
 
+    @model_validator(mode='after')
+    def check_dates_order(self):
+        '''Функция для проверки, что период не перевернут'''
+        if self.start_date and self.end_date and self.start_date > self.end_date:
+            raise PydanticCustomError('date_order', 'start_date is after end_date')
+        return self
+
+class Absence(BaseModel):
+    '''Класс схемы отсутствия работника, обрезанного по запрошенному периоду'''
+    employee_id: int
+    type: VacationType
+    start_date: date
+    end_date: date
+
+class SubdivisionAvailability(BaseModel):
+    '''Класс схемы отсутствий в подразделении с числом отсутствующих по дням'''
+    subdivision_id: int
+    date_from: date
+    date_to: date
+    absences: List[Absence]
+    daily: Dict[str, List[int]] = Field(description="Число отсутствующих по дням от date_from: vacation, business, total")
+
+class VacationBulkConflict(BaseModel):
+    '''Класс схемы отклоненной строки пакетного добавления отпусков'''
+    row: int
+    error: str
+
+class VacationBulkResult(BaseModel):
+    '''Класс схемы результата пакетного добавления отпусков'''
+    created: int
+    conflicts: List[VacationBulkConflict]
+
 class VacationUpdate(BaseModel):
     '''Класс схемы отпуска или командировки,дял обновления'''
     id: int
@@ -126,6 +178,13 @@ class VacationUpdate(BaseModel):
     start_date: date | None = None
     end_date: date | None = None
 
+    @model_validator(mode='after')
+    def check_dates_order(self):
+        '''Функция для проверки, что период не перевернут'''
+        if self.start_date and self.end_date and self.start_date > self.end_date:
+            raise PydanticCustomError('date_order', 'start_date is after end_date')
+        return self
+
 class VacationDelete(BaseModel):
     '''Класс схемы отпуска или командировки для удаления'''
     id:int
@@ -146,6 +205,19 @@ class Subdivision(BaseModel):
         '''Класс настройки для схемы подразделений'''
         from_attributes = True
 
+class SubdivisionSummary(BaseModel):
+    '''Класс схемы подразделения в списке: состав или только число работников'''
+    id: int
+    name: str | None = None
+    leader_id: int | None = None
+    employee_ids: List[int] | None = None
+    employee_count: int | None = None
+
+    @field_validator('name')
+    def to_lower(cls, v):
+        '''Функция для смены регистра в нижний предел'''
+        return v.lower() if isinstance(v, str) else v
+
 class SubdivisionAdd(BaseModel):
     '''Класс схемы подразделения для добавления'''
     id: int
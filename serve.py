@@ -0,0 +1,132 @@
+'''serve.py
+
+Продакшн-запуск: N воркеров uvicorn (uvloop + httptools) на общем сокете,
+схема БД только через миграции aerich, воркеры пересоздаются после max_requests.
+
+Запуск: python -m serve [--migrate]
+'''
+
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import random
+import shutil
+import tempfile
+from socket import socket
+from typing import List, Optional
+import uvicorn
+from uvicorn._subprocess import get_subprocess
+from uvicorn.supervisors.multiprocess import Multiprocess
+from metrics import clear_snapshots
+from settings import Settings, settings
+
+logger = logging.getLogger("uvicorn.error")
+
+def build_config(config: Settings = settings) -> uvicorn.Config:
+    '''Функция для сборки конфигурации uvicorn из настроек'''
+    return uvicorn.Config(
+        "main:create_app",
+        factory=True,
+        host=config.server_host,
+        port=config.server_port,
+        workers=config.server_workers,
+        loop="uvloop",
+        http="httptools",
+        lifespan="on",
+        proxy_headers=True,
+        forwarded_allow_ips=config.server_forwarded_allow_ips,
+        timeout_keep_alive=config.server_keep_alive,
+        timeout_graceful_shutdown=config.server_graceful_timeout,
+        access_log=config.server_access_log,
+        log_level=config.server_log_level,
+    )
+
+def run_worker(config: uvicorn.Config, max_requests: int, jitter: int,
+               sockets: Optional[List[socket]] = None) -> None:
+    '''Функция воркера: обслуживает запросы, пока не наберет свой лимит, и штатно выходит'''
+    if max_requests:
+        # Разброс лимита, чтобы воркеры не пересоздавались одновременно
+        config.limit_max_requests = max_requests + random.randint(0, jitter)
+    uvicorn.Server(config).run(sockets=sockets)
+
+class RecyclingMultiprocess(Multiprocess):
+    '''Класс супервизора uvicorn, заменяющего завершившиеся воркеры новыми'''
+
+    def run(self) -> None:
+        self.startup()
+        while not self.should_exit.wait(0.5):
+            for index, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                process.join()
+                if process.exitcode:
+                    logger.warning("Worker [%s] exited with code %s", process.pid, process.exitcode)
+                    # Не крутить перезапуск, если воркер падает на старте
+                    if self.should_exit.wait(1):
+                        break
+                replacement = get_subprocess(config=self.config, target=self.target, sockets=self.sockets)
+                replacement.start()
+                self.processes[index] = replacement
+                logger.info("Worker [%s] replaced by [%s]", process.pid, replacement.pid)
+        self.shutdown()
+
+async def migrate() -> List[str]:
+    '''Функция для применения миграций aerich один раз до запуска воркеров'''
+    from aerich import Command
+    from tortoise import Tortoise
+    import aerich_config
+
+    command = Command(tortoise_config=aerich_config.TORTOISE_ORM, app="models", location="./migrations")
+    await command.init()
+    try:
+        return await command.upgrade(run_in_transaction=True)
+    finally:
+        await Tortoise.close_connections()
+
+async def refresh_vacation_flags(config: Settings = settings) -> int:
+    '''Функция для пересчета is_vacation один раз до запуска воркеров: сервис мог стоять в полночь'''
+    from tortoise import Tortoise
+    from db import tortoise_config
+    from repository import Repository
+
+    await Tortoise.init(config=tortoise_config(config=config))
+    try:
+        return await Repository.refresh_vacation_flags()
+    finally:
+        await Tortoise.close_connections()
+
+def main() -> None:
+    '''Функция запуска продакшн-сервера'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--migrate", action="store_true", help="Применить миграции aerich перед стартом")
+    args = parser.parse_args()
+
+    if args.migrate:
+        for version in asyncio.run(migrate()):
+            print(f"Applied migration {version}")
+    # Дальше флаги пересчитывает полуночная задача в воркерах
+    print(f"Vacation flags changed: {asyncio.run(refresh_vacation_flags())}")
+    temporary_metrics_dir = None
+    if settings.server_workers > 1 and not settings.metrics_dir:
+        # Без общего каталога /metrics отдает счетчики одного случайного воркера;
+        # воркеры читают настройки заново, поэтому каталог передается через окружение
+        temporary_metrics_dir = tempfile.mkdtemp(prefix="user-service-metrics-")
+        settings.metrics_dir = os.environ["METRICS_DIR"] = temporary_metrics_dir
+        print(f"Metrics directory {temporary_metrics_dir}")
+    if settings.metrics_dir:
+        # Счетчики начинаются заново с каждым запуском супервизора
+        clear_snapshots(settings.metrics_dir)
+    config = build_config()
+    sock = config.bind_socket()
+    target = functools.partial(run_worker, config, settings.server_max_requests,
+                               settings.server_max_requests_jitter)
+    try:
+        RecyclingMultiprocess(config, target=target, sockets=[sock]).run()
+    finally:
+        if temporary_metrics_dir:
+            shutil.rmtree(temporary_metrics_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,29 @@
 '''test_main.py'''
 
-from datetime import date
-from httpx import AsyncClient
+import asyncio
+from datetime import date, timedelta
+import json
+import time
+from httpx import ASGITransport, AsyncClient
+import jwt
 import pytest
-from models import Vacations
+from tortoise import connections
+from tortoise.transactions import in_transaction
+import auth
+from db import PoolAcquireTimeout, ReadYourWritesMiddleware
+from hashing import password_hasher
+from models import Employees, Subdivisions, Vacations
+from auth import ALGORITHM, SECRET_KEY, create_access_token
+from cache import employees_by_id, revoked_tokens
+from repository import REVOKE_TOKEN_SQL, Repository, notify_employee_changes
+from main import create_app
+from metrics import MetricsRegistry, merge_snapshots, read_snapshots, retire_snapshot, write_snapshot
+from metrics import registry as metrics_registry
+from settings import Settings, settings
+from tests.helpers import DB_URL, format_query_budget
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(2)
 async def test_read_all_employees(client: AsyncClient, create_employee):
     ''' Тест функции для  получения всех работников'''
     await create_employee
@@ -18,6 +36,141 @@ async def test_read_all_employees(client: AsyncClient, create_employee):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(2)
+async def test_read_all_employees_keyset(client: AsyncClient, create_employee, create_employee_another):
+    ''' Тест функции для  получения работников постранично с выбором полей'''
+    response = await client.get("/employee/get_all", params={"limit": 1, "fields": "login,email"})
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data) == 1
+    assert set(data[0]) == {"id", "login", "email"}
+    after = response.headers["X-Next-After"]
+    assert after == str(data[0]["id"])
+
+    response = await client.get("/employee/get_all", params={"after": after, "limit": 1})
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data) == 1
+    assert data[0]["id"] > int(after)
+    assert "password" not in data[0]
+
+    response = await client.get("/employee/get_all", params={"fields": "password"})
+    assert response.status_code == 400
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(2)
+async def test_read_all_employees_streamed(client: AsyncClient, create_employee, create_employee_another,
+                                           monkeypatch):
+    ''' Тест функции для  потоковой отдачи списка работников частями через orjson'''
+    # Курсор сразу перед фикстурами: в БД могут быть работники с меньшими id
+    params = {"limit": 2, "after": min(create_employee.id, create_employee_another.id) - 1}
+    validated = await client.get("/employee/get_all", params=params)
+    assert validated.status_code == 200
+
+    monkeypatch.setattr(settings, "list_response_fast_path", True)
+    monkeypatch.setattr(settings, "list_response_chunk_size", 1)
+    response = await client.get("/employee/get_all", params=params)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    data = response.json()
+    assert [employee["id"] for employee in data] == sorted([create_employee.id, create_employee_another.id])
+    assert data == validated.json()
+    assert response.headers["X-Next-After"] == validated.headers["X-Next-After"] == str(data[-1]["id"])
+    assert response.headers["ETag"].startswith('"employees-')
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(1)
+async def test_register_and_login(client: AsyncClient):
+    ''' Тест функции для регистрации и логина с хешированием в пуле'''
+    new_employee = {
+        "last_name": "Hashov",
+        "first_name": "Bcrypt",
+        "email": "hash@google.com",
+        "login": "hashov",
+        "password": "hash123",
+        "is_supervisor": "no",
+    }
+    response = await client.post("/employee/register", params=new_employee)
+    assert response.status_code == 200
+    assert response.json()["token_type"] == "bearer"
+
+    response = await client.post("/employee/token", data={"username": "hashov", "password": "hash123"})
+    assert response.status_code == 200
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    response = await client.get("/employee/users/me", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["login"] == "hashov"
+    response = await client.post("/employee/logout", headers=headers)
+    assert response.status_code == 200
+    response = await client.get("/employee/users/me", headers=headers)
+    assert response.status_code == 401
+    response = await client.get("/employee/users/me", headers={"Authorization": "Bearer broken"})
+    assert response.status_code == 401
+    # Токен без jti не отзывается, поэтому не принимается
+    token = jwt.encode({"sub": "hashov", "exp": int(time.time()) + 60}, SECRET_KEY, algorithm=ALGORITHM)
+    response = await client.get("/employee/users/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 401
+    response = await client.post("/employee/token", data={"username": "hashov", "password": "wrong"})
+    assert response.status_code == 400
+
+    response = await client.get("/service/password_hashing")
+    assert response.status_code == 200
+    assert response.json()["completed"] >= 3
+    await Employees.filter(login="hashov").delete()
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(2)
+@pytest.mark.parametrize("url", [
+    "/employee/get_all",
+    "/subdivision/get_all",
+    "/business_and_vacations/get_all",
+])
+async def test_list_conditional_get(client: AsyncClient, create_employee, url):
+    ''' Тест функции для условного GET списков по ETag'''
+    response = await client.get(url)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = await client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+    await Vacations.create(employee_id=create_employee.id, start_date=date(2024, 12, 1),
+                           end_date=date(2024, 12, 2), type="vacation")
+    await client.post("/subdivision/add", params={"name": "etagsubdivision"})
+    await client.put(f"/employee/update?id={create_employee.id}",
+                     params={"id": create_employee.id, "first_name": "Etag",
+                             "is_supervisor": "no"})
+    response = await client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    await Subdivisions.filter(name="etagsubdivision").delete()
+    assert True
+
+@pytest.mark.asyncio
+async def test_collection_version_compaction(init_db):
+    ''' Тест функции версий коллекций: запись поднимает версию, сворачивание журнала ее не меняет'''
+    before = await Repository.get_collection_version("subdivisions")
+    subdivision = await Subdivisions.create(name="versionsubdivision")
+    try:
+        written = await Repository.get_collection_version("subdivisions")
+        assert written > before
+        await Repository.compact_collection_versions()
+        assert await Repository.get_collection_version("subdivisions") == written
+        rows = await connections.get("default").execute_query_dict(
+            'SELECT count(*) AS "count" FROM "collection_changes"')
+        assert rows[0]["count"] == 0
+    finally:
+        await subdivision.delete()
+    assert await Repository.get_collection_version("subdivisions") > written
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_read_employee(client: AsyncClient, create_employee_another):
     ''' Тест функции для  получения работника'''
     await create_employee_another
@@ -34,6 +187,38 @@ async def test_read_employee(client: AsyncClient, create_employee_another):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.parametrize("lookup", [
+    {"login": "Stas"},
+    {"email": "STAS@google.com"},
+    {"last_name": "denisov"},
+    {"last_name": "denisov", "first_name": "stas"},
+])
+async def test_employee_lookup_uses_index(init_db, lookup):
+    ''' Тест функции поиска работника: план запроса без последовательного сканирования'''
+    sql = Repository.employee_search_query(**lookup).sql()
+    async with in_transaction() as connection:
+        await connection.execute_script("SET LOCAL enable_seqscan = off")
+        _, rows = await connection.execute_query(f"EXPLAIN {sql}")
+    plan = "\n".join(row["QUERY PLAN"] for row in rows)
+    assert "Seq Scan" not in plan, plan
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(2)
+async def test_fuzzy_search_employee(client: AsyncClient, create_employee, create_employee_another):
+    ''' Тест функции для нечеткого поиска работника с опечаткой'''
+    response = await client.get("/employee/search", params={"q": "Salodilof", "limit": 5})
+    assert response.status_code == 200
+    data = response.json()
+    assert 0 < len(data) <= 5
+    assert data[0]["id"] == create_employee_another.id
+
+    response = await client.get("/employee/search", params={"q": "zzzzqqqq"})
+    assert response.status_code == 404
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_add_employee(client: AsyncClient):
     ''' Тест функции для  добавления работника'''
     new_employee = {
@@ -43,6 +228,7 @@ async def test_add_employee(client: AsyncClient):
         "email": "slav@google.com",
         "login": "slav4",
         "password": "slav123",
+        "is_vacation": "yes",
     }
     response = await client.post("/employee/add", params=new_employee)
     assert response.status_code == 200
@@ -53,10 +239,60 @@ async def test_add_employee(client: AsyncClient):
     assert data["email"] == "slav@google.com"
     assert data["login"] == "slav4"
     assert data["password"] == "slav123"
+    # Флаг отпуска выводится из отпусков, а не берется от клиента
+    assert data["is_vacation"] == "no"
     print("Response data:", data)
+    await Employees.filter(id=data["id"]).delete()
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(2)
+async def test_bulk_add_employees(client: AsyncClient, create_employee):
+    ''' Тест функции для пакетного добавления работников'''
+    rows = [
+        {"last_name": "Bulkov", "first_name": "Ivan", "email": "bulk1@google.com",
+         "login": "bulk1", "password": "bulk1", "is_supervisor": "no"},
+        {"last_name": "Bulkov", "first_name": "Petr", "email": "stas@google.com",
+         "login": "bulk2", "password": "bulk2", "is_supervisor": "no"},
+        {"last_name": "Bulkov", "first_name": "Oleg", "email": "bulk3@google.com",
+         "login": "bulk1", "password": "bulk3", "is_supervisor": "no"},
+        {"last_name": "Bulkov"},
+        {"last_name": "Bulkov", "first_name": "Anton", "login": "bulk5"},
+    ]
+    response = await client.post("/employee/bulk", json=rows)
+    assert response.status_code == 200
+    data = response.json()
+    assert [item["row"] for item in data] == [0, 1, 2, 3, 4]
+    assert "id" in data[0]
+    assert data[1]["error"] == "duplicate email"
+    assert data[2]["error"] == "duplicate login"
+    assert "error" in data[3]
+    assert data[4]["error"] == "password is required"
+
+    # Построчный откат после ошибки пачки сообщает настоящую причину, а не дубликат логина
+    results = [{}, {}]
+    await Repository._insert_employee_chunk([
+        (results[0], {"last_name": "bulkov", "first_name": "ivan", "patronymic": None, "email": None,
+                      "login": "bulk1", "password": "x", "is_supervisor": "no"}),
+        (results[1], {"last_name": "bulkov", "first_name": "lev", "patronymic": None, "email": None,
+                      "login": "bulk6", "password": None, "is_supervisor": "no"}),
+    ])
+    assert results == [{"error": "duplicate login"}, {"error": "password is required"}]
+
+    csv_body = ("last_name,first_name,email,login,password,is_supervisor\n"
+                "Bulkova,Anna,bulk4@google.com,bulk4,bulk4,no\n")
+    response = await client.post("/employee/bulk", content=csv_body,
+                                 headers={"Content-Type": "text/csv"})
+    assert response.status_code == 200
+    csv_data = response.json()
+    assert "id" in csv_data[0]
+
+    for item in data[:1] + csv_data:
+        await client.delete(f"/employee/{item['id']}")
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(2)
 async def test_update_employee(client):
     ''' Тест функции для  обновления работника'''
     new_employee = {
@@ -87,10 +323,34 @@ async def test_update_employee(client):
     assert updated_data["email"] == "софья@google.com"
     assert updated_data["login"] == "софьяпаук"
     assert updated_data["password"] == "софьяпаук123"
+    await Employees.filter(id=employee_id).delete()
     assert True
 
+@pytest.mark.asyncio
+@pytest.mark.max_queries(2)
+async def test_employee_cache_invalidation(client: AsyncClient, create_employee):
+    ''' Тест функции кеша работника: повторное чтение из кеша и сброс при обновлении'''
+    response = await client.get(f"/employee/{create_employee.id}")
+    assert response.status_code == 200
+    hits = (await client.get("/service/cache")).json()["employees_by_id"]["hits"]
+    response = await client.get(f"/employee/{create_employee.id}")
+    assert response.status_code == 200
+    assert (await client.get("/service/cache")).json()["employees_by_id"]["hits"] == hits + 1
+
+    response = await client.put(f"/employee/update?id={create_employee.id}",
+                                params={"id": create_employee.id, "first_name": "Stanislav",
+                                        "is_supervisor": "no"})
+    assert response.status_code == 200
+    response = await client.get(f"/employee/{create_employee.id}")
+    assert response.json()["first_name"] == "stanislav"
+
+    await client.delete(f"/employee/{create_employee.id}")
+    response = await client.get(f"/employee/{create_employee.id}")
+    assert response.status_code == 404
+    assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(2)
 async def test_delete_employee(client, create_employee):
     ''' Тест функции для  удаления работника'''
     response = await client.delete(f"/employee/{create_employee.id}")
@@ -106,6 +366,7 @@ async def test_delete_employee(client, create_employee):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(2)
 async def test_delete__not_found_employee(client, create_employee):
     ''' Тест функции для  удаления работника,если его нет'''
     response = await client.delete(f"/employee/{create_employee.id}")
@@ -121,6 +382,7 @@ async def test_delete__not_found_employee(client, create_employee):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(2)
 async def test_read_company_vacations_and_business(client: AsyncClient,create_employee):
     ''' Тест функции для  получения отпусков или командировок'''
     await create_employee
@@ -132,6 +394,63 @@ async def test_read_company_vacations_and_business(client: AsyncClient,create_em
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(1)
+async def test_export_vacations_and_business(client: AsyncClient, create_employee):
+    ''' Тест функции для потоковой выгрузки отпусков и командировок'''
+    await Vacations.create(
+        employee_id=create_employee.id,
+        start_date=date(2024, 7, 1),
+        end_date=date(2024, 7, 10),
+        type="business"
+    )
+    params = {"date_from": "2024-07-05", "date_to": "2024-07-06", "type": "business"}
+    response = await client.get("/business_and_vacations/export", params=params)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert any(row["employee_id"] == create_employee.id for row in rows)
+    assert all(row["type"] == "business" for row in rows)
+
+    response = await client.get("/business_and_vacations/export", params=params,
+                                headers={"Accept": "text/csv"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    lines = response.text.splitlines()
+    assert lines[0] == "id,employee_id,type,start_date,end_date"
+    assert len(lines) == len(rows) + 1
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(5)
+async def test_read_subdivision_availability(client: AsyncClient, create_employee, create_employee_another):
+    ''' Тест функции для получения отсутствующих в подразделении по дням'''
+    response = await client.post("/subdivision/add",
+                                 params={"name": "awaysubdivision", "leader_id": create_employee.id})
+    subdivision_id = response.json()["id"]
+    try:
+        await client.put("/subdivision/assign_employee",
+                         params={"subdivision_id": subdivision_id, "employee_id": create_employee_another.id})
+        await Vacations.create(employee_id=create_employee.id, start_date=date(2024, 5, 30),
+                               end_date=date(2024, 6, 2), type="vacation")
+        await Vacations.create(employee_id=create_employee_another.id, start_date=date(2024, 6, 2),
+                               end_date=date(2024, 6, 3), type="business")
+        response = await client.get("/business_and_vacations/availability", params={
+            "subdivision_id": subdivision_id, "date_from": "2024-06-01", "date_to": "2024-06-04"})
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["absences"]) == 2
+        assert data["absences"][0]["start_date"] in ("2024-06-01", "2024-06-02")
+        assert data["daily"] == {"vacation": [1, 1, 0, 0], "business": [0, 1, 1, 0], "total": [1, 2, 1, 0]}
+
+        response = await client.get("/business_and_vacations/availability", params={
+            "subdivision_id": subdivision_id, "date_from": "2024-06-04", "date_to": "2024-06-01"})
+        assert response.status_code == 400
+    finally:
+        await client.delete(f"/subdivision/{subdivision_id}")
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_get_employees_with_vacations_vacation(client, create_employee):
     ''' Тест функции для  получения у работника отпуска или командировки'''
     vacation1 = await Vacations.create(
@@ -158,6 +477,7 @@ async def test_get_employees_with_vacations_vacation(client, create_employee):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_get_employees_with_vacations_business(client, create_employee):
     ''' Тест функции для получения у работника отпуска или командировки по фильтру бизнес '''
     vacation1 = await Vacations.create(
@@ -184,6 +504,7 @@ async def test_get_employees_with_vacations_business(client, create_employee):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_get_employees_with_vacations_with_filter(client, create_employee):
     ''' Тест функции для получения у работника отпуска или командировки по фильтру отпуск '''
     vacation1 = await Vacations.create(
@@ -236,6 +557,43 @@ async def test_get_employees_with_vacations_with_filter(client, create_employee)
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(1)
+async def test_get_employees_with_vacations_window_and_pages(client, create_employee):
+    ''' Тест функции для поиска отпусков по периоду с пропуском работников без совпадений и страницами'''
+    other = await Employees.create(last_name="Petrov", first_name="Petr", login="petrov",
+                                   email="petrov@example.com", password="x",
+                                   is_supervisor="no", is_vacation="no")
+    try:
+        await Vacations.create(employee_id=create_employee.id, start_date=date(2024, 6, 1),
+                               end_date=date(2024, 6, 15), type="vacation")
+        await Vacations.create(employee_id=create_employee.id, start_date=date(2024, 9, 1),
+                               end_date=date(2024, 9, 10), type="vacation")
+        await Vacations.create(employee_id=other.id, start_date=date(2024, 6, 10),
+                               end_date=date(2024, 6, 20), type="vacation")
+        response = await client.get("/business_and_vacations/search", params={
+            "type": "vacation", "date_from": "2024-06-14", "date_to": "2024-07-01", "limit": 1})
+        assert response.status_code == 200
+        data = response.json()
+        assert [employee["id"] for employee in data] == [create_employee.id]
+        assert [vacation["start_date"] for vacation in data[0]["vacations"]] == ["2024-06-01"]
+        response = await client.get("/business_and_vacations/search", params={
+            "type": "vacation", "date_from": "2024-06-14", "date_to": "2024-07-01",
+            "limit": 1, "after": response.headers["X-Next-After"]})
+        assert [employee["id"] for employee in response.json()] == [other.id]
+
+        response = await client.get("/business_and_vacations/search", params={
+            "type": "vacation", "date_from": "2024-08-01", "date_to": "2024-08-31"})
+        assert response.status_code == 404
+        response = await client.get("/business_and_vacations/search", params={
+            "type": "business", "employee_id": create_employee.id})
+        assert response.status_code == 404
+    finally:
+        # Отпуска удаляются каскадом вместе с работником
+        await other.delete()
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_get_employees_with_vacations_no_employees_if_business(client):
     ''' Тест функции для получения работника с командировкой,если нет работника'''
     response = await client.get("/business_and_vacations/search?employee_id=999&type=business")
@@ -245,6 +603,7 @@ async def test_get_employees_with_vacations_no_employees_if_business(client):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_get_employees_with_vacations_no_employees_if_vacation(client):
     ''' Тест функции для получения работника с отпуском ,если нет работника'''
     response = await client.get("/business_and_vacations/search?employee_id=999&type=vacation")
@@ -254,6 +613,7 @@ async def test_get_employees_with_vacations_no_employees_if_vacation(client):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_add_vacations_or_business(client: AsyncClient, create_employee):
     '''Тест функции для добавления отпуск или командировки для работника'''
     response = await client.post("/business_and_vacations/add", params={
@@ -271,6 +631,7 @@ async def test_add_vacations_or_business(client: AsyncClient, create_employee):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(2)
 async def test_add_vacation_with_overlapping_dates(client: AsyncClient,create_employee):
     ''' Тест функции для добавления отпуска или командировки,если даты пересекаются'''
     await Vacations.create(
@@ -289,6 +650,95 @@ async def test_add_vacation_with_overlapping_dates(client: AsyncClient,create_em
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(2)
+async def test_bulk_add_vacations_or_business(client: AsyncClient, create_employee):
+    ''' Тест функции для пакетного добавления отпусков с пересечениями'''
+    await Vacations.create(
+        employee_id=create_employee.id,
+        start_date=date(2024, 8, 1),
+        end_date=date(2024, 8, 10),
+        type="vacation"
+    )
+    rows = [
+        {"employee_id": create_employee.id, "start_date": "2024-09-01",
+         "end_date": "2024-09-10", "type": "vacation"},
+        {"employee_id": create_employee.id, "start_date": "2024-09-05",
+         "end_date": "2024-09-12", "type": "business"},
+        {"employee_id": create_employee.id, "start_date": "2024-08-05",
+         "end_date": "2024-08-07", "type": "business"},
+        {"employee_id": create_employee.id, "start_date": "2024-10-01",
+         "end_date": "2024-10-03", "type": "business"},
+        {"employee_id": create_employee.id, "start_date": "2024-11-05",
+         "end_date": "2024-11-01", "type": "vacation"},
+        {"employee_id": create_employee.id + 100000, "start_date": "2024-12-01",
+         "end_date": "2024-12-03", "type": "vacation"},
+    ]
+    response = await client.post("/business_and_vacations/bulk", json=rows)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["created"] == 2
+    assert data["conflicts"] == [
+        {"row": 1, "error": "overlaps row 0"},
+        {"row": 2, "error": "overlaps existing vacation"},
+        {"row": 4, "error": "start_date is after end_date"},
+        {"row": 5, "error": "unknown employee_id"},
+    ]
+    assert await Vacations.filter(employee_id=create_employee.id).count() == 3
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(3)
+async def test_vacation_flag_follows_vacations(client: AsyncClient, create_employee):
+    ''' Тест функции для автоматического пересчета is_vacation по отпускам'''
+    today = date.today()
+    response = await client.post("/business_and_vacations/add", params={
+        "employee_id": create_employee.id,
+        "start_date": str(today - timedelta(days=1)),
+        "end_date": str(today + timedelta(days=1)),
+        "type": "vacation"
+    })
+    assert response.status_code == 200
+    vacation_id = response.json()["id"]
+    assert (await client.get(f"/employee/{create_employee.id}")).json()["is_vacation"] == "yes"
+
+    response = await client.put(f"/business_and_vacations/update?id={vacation_id}", params={
+        "start_date": str(today + timedelta(days=10)),
+        "end_date": str(today + timedelta(days=12)),
+        "type": "vacation"
+    })
+    assert response.status_code == 200
+    assert (await client.get(f"/employee/{create_employee.id}")).json()["is_vacation"] == "no"
+
+    assert await Repository.refresh_vacation_flags(today=today + timedelta(days=11)) >= 1
+    assert (await Employees.get(id=create_employee.id)).is_vacation == "yes"
+    assert await Repository.refresh_vacation_flags() == 1
+    # UPDATE без изменившихся строк не сбрасывает ETag списка работников
+    version = await Repository.get_collection_version("employees")
+    assert await Repository.refresh_vacation_flags() == 0
+    assert await Repository.get_collection_version("employees") == version
+
+    # Отпуск, не покрывающий сегодня, флаг не меняет: пересчета нет
+    response = await client.post("/business_and_vacations/add", params={
+        "employee_id": create_employee.id,
+        "start_date": str(today + timedelta(days=20)),
+        "end_date": str(today + timedelta(days=21)),
+        "type": "business"
+    })
+    assert response.status_code == 200
+    assert len(metrics_registry.traces[-1][1]) == 1
+
+    response = await client.put(f"/business_and_vacations/update?id={vacation_id}", params={
+        "start_date": str(today),
+        "end_date": str(today),
+        "type": "vacation"
+    })
+    assert (await Employees.get(id=create_employee.id)).is_vacation == "yes"
+    await client.delete(f"/business_and_vacations/{vacation_id}")
+    assert (await Employees.get(id=create_employee.id)).is_vacation == "no"
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_update_vacations_or_business(client,create_employee):
     ''' Тест функции для обновления отпуска или командировки'''
     vacation = await Vacations.create(
@@ -314,6 +764,51 @@ async def test_update_vacations_or_business(client,create_employee):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(2)
+async def test_update_vacation_overlap_scoped_to_employee(client, create_employee, create_employee_another):
+    ''' Тест функции для обновления отпуска: пересечение только с отпусками того же работника'''
+    await Vacations.create(employee_id=create_employee_another.id, start_date=date(2025, 1, 1),
+                           end_date=date(2025, 1, 20), type="vacation")
+    own = await Vacations.create(employee_id=create_employee.id, start_date=date(2025, 2, 1),
+                                 end_date=date(2025, 2, 5), type="vacation")
+    vacation = await Vacations.create(employee_id=create_employee.id, start_date=date(2025, 3, 1),
+                                      end_date=date(2025, 3, 5), type="vacation")
+    response = await client.put(f"/business_and_vacations/update?id={vacation.id}",
+                                params={"start_date": "2025-01-10", "end_date": "2025-01-15",
+                                        "type": "business"})
+    assert response.status_code == 200
+    assert response.json()["type"] == "business"
+
+    response = await client.put(f"/business_and_vacations/update?id={vacation.id}",
+                                params={"start_date": "2025-02-05", "end_date": "2025-02-10",
+                                        "type": "vacation"})
+    assert response.status_code == 404
+    await own.refresh_from_db()
+    assert own.end_date == date(2025, 2, 5)
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(1)
+async def test_vacation_reversed_dates(client, create_employee):
+    ''' Тест функции для отклонения перевернутого периода: 422 вместо ошибки daterange'''
+    response = await client.post("/business_and_vacations/add", params={
+        "employee_id": create_employee.id, "start_date": "2025-04-10", "end_date": "2025-04-01",
+        "type": "vacation"})
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["msg"] == "start_date is after end_date"
+
+    vacation = await Vacations.create(employee_id=create_employee.id, start_date=date(2025, 4, 1),
+                                      end_date=date(2025, 4, 5), type="vacation")
+    # Перевернутым период становится только вместе с сохраненной датой - его ловит CHECK
+    response = await client.put(f"/business_and_vacations/update?id={vacation.id}",
+                                params={"end_date": "2025-03-20", "type": "vacation"})
+    assert response.status_code == 422
+    await vacation.refresh_from_db()
+    assert vacation.end_date == date(2025, 4, 5)
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(2)
 async def test_delete_vacation_success(client,create_employee):
     ''' Тест функции для удаления отпуска или командировки'''
     vacation = await Vacations.create(
@@ -335,6 +830,7 @@ async def test_delete_vacation_success(client,create_employee):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(3)
 async def test_delete_vacation__not_found(client,create_employee):
     ''' Тест функции для удаления отпуска или командировки,если нет отпуска или командировки'''
     vacation = await Vacations.create(
@@ -356,6 +852,7 @@ async def test_delete_vacation__not_found(client,create_employee):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(2)
 async def test_read_all_subdivisions(client):
     ''' Тест функции для получения всех подразделений'''
     response = await client.get("/subdivision/get_all")
@@ -367,6 +864,119 @@ async def test_read_all_subdivisions(client):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(5)
+async def test_read_all_subdivisions_aggregated(client, create_employee, create_employee_another):
+    ''' Тест функции для получения подразделений с составом и числом работников'''
+    response = await client.post("/subdivision/add",
+                                 params={"name": "aggsubdivision", "leader_id": create_employee.id})
+    subdivision_id = response.json()["id"]
+    try:
+        for employee in (create_employee, create_employee_another):
+            await client.put("/subdivision/assign_employee",
+                             params={"subdivision_id": subdivision_id, "employee_id": employee.id})
+        response = await client.get("/subdivision/get_all", params={"after": subdivision_id - 1, "limit": 1})
+        assert response.status_code == 200
+        data = response.json()
+        assert data == [{
+            "id": subdivision_id,
+            "name": "aggsubdivision",
+            "leader_id": create_employee.id,
+            "employee_ids": sorted([create_employee.id, create_employee_another.id]),
+        }]
+        assert response.headers["X-Next-After"] == str(subdivision_id)
+
+        response = await client.get("/subdivision/get_all",
+                                    params={"after": subdivision_id - 1, "limit": 1, "counts_only": True})
+        assert response.json()[0]["employee_count"] == 2
+        assert "employee_ids" not in response.json()[0]
+    finally:
+        await client.delete(f"/subdivision/{subdivision_id}")
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(5)
+async def test_org_chart_snapshot(client, org_chart_snapshot, create_employee, create_employee_another):
+    ''' Тест функции снимка подразделений: патчи записей и сверка с БД'''
+    response = await client.post("/subdivision/add",
+                                 params={"name": "snapshotsubdivision", "leader_id": create_employee.id})
+    subdivision_id = response.json()["id"]
+    try:
+        await client.put("/subdivision/assign_employee",
+                         params={"subdivision_id": subdivision_id, "employee_id": create_employee_another.id})
+        await client.put(f"/subdivision/{subdivision_id}/assign_leader/{create_employee_another.id}")
+        assert org_chart_snapshot.get(subdivision_id) == {
+            "id": subdivision_id,
+            "name": "snapshotsubdivision",
+            "leader_id": create_employee_another.id,
+            "employee_ids": [create_employee_another.id],
+        }
+        response = await client.delete(f"/subdivision/{subdivision_id}/employee/{create_employee_another.id}")
+        assert response.json()["employee_ids"] == []
+
+        response = await client.post("/service/org_chart/check")
+        assert response.status_code == 200
+        assert response.json()["consistent"] is True
+    finally:
+        await client.delete(f"/subdivision/{subdivision_id}")
+    assert org_chart_snapshot.get(subdivision_id) is None
+    assert True
+
+@pytest.mark.asyncio
+async def test_org_chart_listener_reconnect(init_db, org_chart_snapshot):
+    ''' Тест функции отключения снимка при разрыве подписки и его пересборки после переподключения'''
+    pid = org_chart_snapshot._listener.get_server_pid()
+    await connections.get("default").execute_query("SELECT pg_terminate_backend($1)", [pid])
+    for _ in range(100):
+        if org_chart_snapshot._listener is not None and org_chart_snapshot._listener.get_server_pid() != pid:
+            break
+        await asyncio.sleep(0.05)
+    assert org_chart_snapshot.loaded is True
+    assert org_chart_snapshot._listener.get_server_pid() != pid
+    assert True
+
+@pytest.mark.asyncio
+async def test_revoked_token_cross_worker(client, org_chart_snapshot):
+    ''' Тест функции отзыва токена в другом воркере: по NOTIFY и из БД при переподключении'''
+    token = create_access_token({"sub": "nobody"}, timedelta(minutes=1))
+    claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    # Отзыв мимо Repository: локально токен появляется только по подписке
+    await connections.get("default").execute_query(REVOKE_TOKEN_SQL, [claims["jti"], claims["exp"]])
+    for _ in range(100):
+        if claims["jti"] in revoked_tokens:
+            break
+        await asyncio.sleep(0.05)
+    assert claims["jti"] in revoked_tokens
+    response = await client.get("/employee/users/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.json()["detail"] == "Token revoked"
+
+    revoked_tokens.clear()
+    await org_chart_snapshot.close()
+    await Repository.load_org_chart(DB_URL)
+    assert claims["jti"] in revoked_tokens
+    await connections.get("default").execute_query('DELETE FROM "revoked_tokens"')
+    assert True
+
+@pytest.mark.asyncio
+async def test_employee_cache_cross_worker_invalidation(client, org_chart_snapshot, create_employee):
+    ''' Тест функции сброса кеша работника по NOTIFY от записи в другом воркере'''
+    response = await client.get(f"/employee/{create_employee.id}")
+    assert response.status_code == 200
+    assert create_employee.id in employees_by_id
+    # Запись мимо Repository: локального сброса нет, кеш чистит только подписка
+    await connections.get("default").execute_query(notify_employee_changes(
+        'UPDATE "employees" SET "first_name" = \'other\' WHERE "id" = $1 RETURNING "id", "login"'),
+        [create_employee.id])
+    for _ in range(100):
+        if create_employee.id not in employees_by_id:
+            break
+        await asyncio.sleep(0.05)
+    assert create_employee.id not in employees_by_id
+    response = await client.get(f"/employee/{create_employee.id}")
+    assert response.json()["first_name"] == "other"
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_read_subdivision(client):
     ''' Тест функции для получения подразделения'''
     subdivision_id = 1
@@ -380,6 +990,7 @@ async def test_read_subdivision(client):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(3)
 async def test_add_subdivision(client, create_employee):
     ''' Тест функции для добавления подразделения'''
     add_payload = {"name": "newsubdivision", "leader_id": create_employee.id}
@@ -399,6 +1010,7 @@ async def test_add_subdivision(client, create_employee):
 
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_update_subdivision(client):
     ''' Тест функции для обновления подразделения'''
     subdivision_id = 1
@@ -413,6 +1025,7 @@ async def test_update_subdivision(client):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(2)
 async def test_assign_leader(client):
     ''' Тест функции для прикрепления к подразделению руководителя'''
     subdivision_id = 1
@@ -427,6 +1040,7 @@ async def test_assign_leader(client):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_assign_employee_to_subdivision(client):
     ''' Тест функции для прикрепления работника к подразделению'''
     response = await client.put("/subdivision/assign_employee",
@@ -440,6 +1054,7 @@ async def test_assign_employee_to_subdivision(client):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_remove_employee_from_subdivision(client):
     ''' Тест функции для открепления работника от подразделения'''
     response = await client.delete("/subdivision/1/employee/1")
@@ -452,6 +1067,7 @@ async def test_remove_employee_from_subdivision(client):
     assert True
 
 @pytest.mark.asyncio
+@pytest.mark.max_queries(1)
 async def test_delete_subdivision(client):
     ''' Тест функции для удаления подразделения'''
     response = await client.delete("/subdivision/1")
@@ -461,3 +1077,180 @@ async def test_delete_subdivision(client):
         assert response.status_code == 200
         assert response.json() == {"detail": "Subdivision deleted"}
     assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(5)
+async def test_assign_employee_to_subdivision_existing(client, create_subdivision, create_employee):
+    ''' Тест функции для прикрепления существующего работника к существующему подразделению'''
+    response = await client.put("/subdivision/assign_employee",
+                                params={"subdivision_id": create_subdivision.id, "employee_id": create_employee.id})
+    assert response.status_code == 200
+    assert response.json() == {"id": create_subdivision.id, "name": "fixturesubdivision"}
+    assert [employee.id for employee in await create_subdivision.employees.all()] == [create_employee.id]
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(5)
+async def test_remove_employee_from_subdivision_existing(client, create_subdivision, create_employee,
+                                                         create_employee_another):
+    ''' Тест функции для открепления работника от подразделения с возвратом оставшегося состава'''
+    await create_subdivision.employees.add(create_employee, create_employee_another)
+    response = await client.delete(f"/subdivision/{create_subdivision.id}/employee/{create_employee.id}")
+    assert response.status_code == 200
+    assert response.json()["employee_ids"] == [create_employee_another.id]
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(3)
+async def test_delete_subdivision_existing(client, create_subdivision, create_employee):
+    ''' Тест функции для удаления подразделения вместе с составом'''
+    await create_subdivision.employees.add(create_employee)
+    response = await client.delete(f"/subdivision/{create_subdivision.id}")
+    assert response.status_code == 200
+    assert response.json() == {"detail": "Subdivision deleted"}
+    assert await Subdivisions.filter(id=create_subdivision.id).exists() is False
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(1)
+async def test_db_pool_metrics(client: AsyncClient, create_employee):
+    ''' Тест функции для получения метрик пула соединений и таймаута захвата'''
+    await client.get(f"/employee/{create_employee.id}")
+    response = await client.get("/service/db_pool")
+    assert response.status_code == 200
+    metrics = response.json()
+    assert metrics["max_size"] == settings.db_pool_max_size
+    assert metrics["acquired"] > 0
+    assert metrics["in_use"] == 0 and metrics["waiting"] == 0
+
+    pool = connections.get("default")._pool
+    held = [await pool.acquire() for _ in range(pool.get_max_size())]
+    try:
+        with pytest.raises(PoolAcquireTimeout):
+            await pool.acquire(timeout=0.05)
+        assert pool.metrics()["timeouts"] == 1
+        assert pool.metrics()["in_use"] == pool.get_max_size()
+    finally:
+        for connection in held:
+            await pool.release(connection)
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(2)
+async def test_metrics_by_route(client: AsyncClient, create_employee, tmp_path):
+    ''' Тест функции для выдачи метрик по шаблонам маршрутов и слияния снимков воркеров'''
+    await client.get("/employee/get_all")
+    await client.get("/employee/0")
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = dict(line.rsplit(" ", 1) for line in response.text.splitlines() if not line.startswith("#"))
+    label = 'method="GET",route="/employee/get_all"'
+    requests = int(lines[f"http_request_duration_seconds_count{{{label}}}"])
+    assert requests >= 1
+    assert int(lines[f'http_request_duration_seconds_bucket{{{label},le="+Inf"}}']) == requests
+    assert int(lines[f"http_request_db_queries_total{{{label}}}"]) >= requests
+    assert float(lines[f"http_request_db_seconds_total{{{label}}}"]) > 0
+    assert int(lines[f"http_response_size_bytes_total{{{label}}}"]) > 0
+    assert 'http_requests_total{method="GET",route="/employee/{user_id}",status="404"}' in lines
+
+    def requests_in(directory) -> list:
+        '''Функция для подсчета запросов по всем снимкам каталога'''
+        return [item["requests"] for item in merge_snapshots(read_snapshots(str(directory)))["routes"]]
+
+    workers = [MetricsRegistry(), MetricsRegistry(), MetricsRegistry()]
+    workers[1].worker_id += "-other"
+    # Такого pid в Linux не бывает: снимок воркера, упавшего без штатной остановки
+    workers[2].worker_id = "999999999-1"
+    for worker in workers:
+        worker.route("/employee/get_all", "GET").requests = 2
+        await write_snapshot(str(tmp_path), worker)
+    assert requests_in(tmp_path) == [6]
+
+    workers[0].route("/employee/get_all", "GET").requests = 3
+    await retire_snapshot(str(tmp_path), workers[0])
+    assert sorted(path.name for path in tmp_path.glob("*.json")) == [f"{workers[1].worker_id}.json", "retired.json"]
+    assert requests_in(tmp_path) == [7]
+    # Запоздавший периодический сброс не должен вернуть уже свернутый снимок
+    await write_snapshot(str(tmp_path), workers[0])
+    assert requests_in(tmp_path) == [7]
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(2)
+async def test_query_budget_report(client: AsyncClient, create_employee):
+    ''' Тест функции для записи SQL-запросов каждого HTTP-запроса и отчета о превышении бюджета'''
+    await client.get("/employee/get_all")
+    request, statements = metrics_registry.traces[-1]
+    assert request == "GET /employee/get_all"
+    assert any('FROM "employees"' in statement for statement in statements)
+    report = format_query_budget(1, [(request, statements)])
+    assert report.startswith("Query budget exceeded: max_queries=1")
+    assert f"GET /employee/get_all ran {len(statements)} SQL statements:" in report
+    assert f"  1. {statements[0]}" in report
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(2)
+async def test_reads_routed_to_replica(client: AsyncClient, replica_db, create_employee):
+    ''' Тест функции для чтения из реплики и чтения своих записей из primary'''
+    await replica_db.execute_query(
+        "INSERT INTO employees (last_name, first_name, login, email, password, is_supervisor, is_vacation) "
+        "VALUES ('replica', 'only', 'replica', 'replica@example.com', 'x', 'no', 'no')")
+    response = await client.get("/employee/get_all")
+    assert [employee["login"] for employee in response.json()] == ["replica"]
+
+    response = await client.post("/business_and_vacations/add", params={
+        "employee_id": create_employee.id, "start_date": "2024-02-01",
+        "end_date": "2024-02-05", "type": "vacation"})
+    assert response.status_code == 200
+    vacation_id = response.json()["id"]
+    assert "read_primary_until" in client.cookies
+    response = await client.get("/employee/get_all")
+    assert create_employee.id in [employee["id"] for employee in response.json()]
+    response = await client.get("/business_and_vacations/get_all")
+    assert vacation_id in [vacation["id"] for vacation in response.json()]
+
+    client.cookies.clear()
+    response = await client.get("/employee/get_all")
+    assert [employee["login"] for employee in response.json()] == ["replica"]
+    assert (await client.get("/business_and_vacations/get_all")).json() == []
+    assert (await client.get("/service/db_pool", params={"connection": "replica"})).json()["acquired"] > 0
+    assert True
+
+@pytest.mark.asyncio
+@pytest.mark.max_queries(0)
+async def test_create_app_warm_up(init_db):
+    ''' Тест функции для сборки приложения фабрикой с прогревом в lifespan'''
+    app = create_app(Settings(database_url=DB_URL))
+    async with app.router.lifespan_context(app):
+        assert connections.get("default")._pool is not None
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+            response = await client.get("/service/startup")
+    assert response.status_code == 200
+    report = response.json()
+    for step in ("import_cpu_ms", "db_init_ms", "pool_open_ms", "warm_up_query_ms", "openapi_ms", "startup_ms"):
+        assert report[step] >= 0
+    assert app.openapi_schema is not None
+    assert True
+
+@pytest.mark.asyncio
+async def test_create_app_uses_config(init_db):
+    ''' Тест функции для сборки приложения: переданная конфигурация доходит до middleware, JWT, кешей и пула'''
+    config = Settings(database_url=DB_URL, jwt_secret_key="other-secret", employee_cache_size=7,
+                      password_hash_workers=2, password_hash_queue_size=3,
+                      replica_read_your_writes_seconds=1.5)
+    try:
+        app = create_app(config)
+        window = next(middleware.kwargs["window"] for middleware in app.user_middleware
+                      if middleware.cls is ReadYourWritesMiddleware)
+        assert window == 1.5
+        assert auth.SECRET_KEY == "other-secret"
+        token = auth.create_access_token({"sub": "nobody"})
+        assert jwt.decode(token, "other-secret", algorithms=[ALGORITHM])["sub"] == "nobody"
+        assert employees_by_id.maxsize == 7
+        assert password_hasher.max_pending == 5
+    finally:
+        create_app(settings)
+    assert auth.SECRET_KEY == settings.jwt_secret_key
+    assert True